@@ -20,10 +20,12 @@ def prepare(time_file,hospital_address=None,hospital_key=None):
     Generate travel times and hospital files for the given travel
         times file with identifying information removed.
     '''
-    name = os.path.basename(time_file)
+    name = os.path.splitext(os.path.basename(time_file))[0] + '.csv'
+    # pivots the long format store to the model's wide format if there is one
     times = travel_times.read_travel_times(time_file)
     # Deidentify, drop columns that show locations/not needed
-    times = times.drop(columns=['Latitude', 'Longitude','Need_Update'])
+    times = times.drop(columns=['Latitude', 'Longitude','Need_Update'],
+                       errors='ignore')
     hosp_ids = [x for x in times.columns]
 
     if hospital_address is None: hospital_address = data_io.HOSPITAL_ADDY
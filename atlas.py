@@ -0,0 +1,402 @@
+'''
+Precomputed per-state sampling atlases. An atlas holds every census block
+    with a positive weight, its triangulation, and a Walker alias table over
+    the blocks, saved as .npy files so that points can be drawn from
+    memory-mapped arrays without reading any shapefiles. A stamp of the
+    census files and registered weights it was built from is kept with it,
+    and the atlas is rebuilt when either changes.
+'''
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import shapely
+from scipy.stats import qmc
+import census
+
+ATLAS_DIR = os.path.join('data', 'atlas')
+if not os.path.isdir(ATLAS_DIR):
+    os.makedirs(ATLAS_DIR)
+
+ARRAYS = [
+    'geoid', 'weights', 'vertices', 'cum_areas', 'starts', 'ends', 'prob',
+    'alias', 'total'
+]
+STAMP_FILE = 'stamp.json'
+# Divisors of a block GEOID giving its county or tract (with the state)
+STRATA = {'county': 10**10, 'tract': 10**4}
+
+
+def triangulate(polys):
+    '''
+    Split polygons into triangles. Returns an array of triangle vertices with
+        shape (triangles, 3, 2), the index of the polygon each triangle came
+        from, and the area of each triangle
+    '''
+    triangles = shapely.constrained_delaunay_triangles(np.asarray(polys))
+    parts, owner = shapely.get_parts(triangles, return_index=True)
+    # each triangle is a closed ring of four coordinates, drop the repeat
+    vertices = shapely.get_coordinates(parts).reshape(-1, 4, 2)[:, :3]
+    return vertices, owner, shapely.area(parts)
+
+
+def triangle_offsets(owner, areas, n_polys):
+    '''
+    Get the cumulative triangle areas and the range of triangles
+        [starts, ends) belonging to each polygon
+    '''
+    cum_areas = np.cumsum(areas)
+    ends = np.searchsorted(owner, np.arange(n_polys), side='right')
+    starts = np.concatenate([[0], ends[:-1]])
+    return cum_areas, starts, ends
+
+
+def draw_in_triangles(vertices,
+                      cum_areas,
+                      starts,
+                      ends,
+                      which,
+                      rng,
+                      uniforms=None):
+    '''
+    Draw a point uniformly from inside polygon i for each i in which, by
+        choosing one of its triangles with probability proportional to area
+        and drawing barycentric coordinates inside it. Three uniforms per
+        point can be given (e.g. from a low-discrepancy sequence) in place
+        of draws from rng. Returns an array of (x, y) coordinates.
+    '''
+    if uniforms is None:
+        u = rng.random(len(which))
+        r = rng.random((len(which), 2))
+    else:
+        u, r = uniforms[:, 0], uniforms[:, 1:].copy()
+    first, last = starts[which], ends[which] - 1
+    offsets = np.where(first > 0, cum_areas[np.maximum(first - 1, 0)], 0)
+    totals = cum_areas[last] - offsets
+    targets = offsets + u * totals
+    tri = np.searchsorted(cum_areas, targets, side='right')
+    tri = np.clip(tri, first, last)
+
+    # uniform barycentric coordinates, reflecting draws from the far half
+    flip = r.sum(axis=1) > 1
+    r[flip] = 1 - r[flip]
+    corners = vertices[tri]
+    a, b, c = corners[:, 0], corners[:, 1], corners[:, 2]
+    return a + r[:, :1] * (b - a) + r[:, 1:] * (c - a)
+
+
+def alias_table(weights):
+    '''
+    Build a Walker alias table (Vose's method) for drawing indices with
+        probability proportional to weights in constant time per draw
+    '''
+    weights = np.asarray(weights, dtype=float)
+    n = len(weights)
+    scaled = weights * n / weights.sum()
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = list(np.flatnonzero(scaled < 1))
+    large = list(np.flatnonzero(scaled >= 1))
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1 - scaled[s]
+        if scaled[l] < 1:
+            small.append(l)
+        else:
+            large.append(l)
+    return prob, alias
+
+
+def alias_draw(prob, alias, n, rng):
+    '''Draw n indices from an alias table'''
+    i = rng.integers(len(prob), size=n)
+    return np.where(rng.random(n) < prob[i], i, alias[i])
+
+
+def _atlas_path(state, weights):
+    return os.path.join(ATLAS_DIR, state.abbr, weights)
+
+
+def _read_blocks(state, weights):
+    '''Census blocks and weights used to build the atlas for a state'''
+    if weights in census.WEIGHTS:
+        data, _ = census.read_states_age_adjusted([state.abbr],
+                                                  weights=[weights])
+    else:
+        data, _ = census.read_states([state.abbr])
+    data = data[data[weights].astype(float) > 0]
+    id_col = 'GEOID10' if 'GEOID10' in data.columns else 'BLOCKID10'
+    geoid = data[id_col].to_numpy(dtype=np.int64)
+    return data.geometry.values, data[weights].to_numpy(dtype=float), geoid
+
+
+def build_atlas(state, weights='POP10'):
+    '''
+    Build and save the sampling atlas for one state (a `us` state object)
+        and weight column, reading its census shapefiles
+    '''
+    polys, block_weights, geoid = _read_blocks(state, weights)
+    vertices, owner, areas = triangulate(polys)
+    cum_areas, starts, ends = triangle_offsets(owner, areas, len(polys))
+    prob, alias = alias_table(block_weights)
+    arrays = {
+        'geoid': geoid,
+        'weights': block_weights,
+        'vertices': vertices,
+        'cum_areas': cum_areas,
+        'starts': starts,
+        'ends': ends,
+        'prob': prob,
+        'alias': alias,
+        'total': np.array([block_weights.sum()]),
+    }
+    path = _atlas_path(state, weights)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for key, values in arrays.items():
+        np.save(os.path.join(path, f'{key}.npy'), values)
+    _write_stamp(state, weights, _source_stamps(state, weights))
+
+
+def _source_files(state, weights):
+    '''Census files an atlas is built from, without downloading any'''
+    if weights in census.WEIGHTS:
+        shapefile = census.SHAPEFILE_PATH / f'tl_2018_{state.fips}_tabblock10.shp'
+        summary = (census.CENSUS_SUMMARYFILE_PATH /
+                   f'{state.abbr}_blocks_from_all_counties.csv')
+        return census._source_files(shapefile) + [summary]
+    d = census._get_path(state)
+    if not os.path.isdir(d):
+        return []
+    return [
+        f for name in sorted(os.listdir(d)) if name.endswith('.shp')
+        for f in census._source_files(os.path.join(d, name))
+    ]
+
+
+def _source_stamps(state, weights, hashes=True):
+    '''
+    Modification time (and hash) of each existing census source of an atlas
+    '''
+    return {
+        str(f): {
+            'mtime': os.path.getmtime(f),
+            'sha256': census._file_hash(f) if hashes else None
+        }
+        for f in _source_files(state, weights) if os.path.exists(f)
+    }
+
+
+def _version(weights):
+    '''Registered weights an atlas depends on, as in the census cache'''
+    return census._weights_version() if weights in census.WEIGHTS else ''
+
+
+def _write_stamp(state, weights, sources):
+    path = os.path.join(_atlas_path(state, weights), STAMP_FILE)
+    with open(path, 'w') as f:
+        json.dump({'version': _version(weights), 'sources': sources}, f)
+
+
+def _has_atlas(state, weights):
+    '''
+    Check that a complete atlas exists and is up to date: built with the same
+        registered weights, from census sources with the same modification
+        times or, failing that, the same hashes. Sources that have since been
+        deleted are not checked, so atlases can be kept without census data.
+    '''
+    path = _atlas_path(state, weights)
+    stamp_path = os.path.join(path, STAMP_FILE)
+    if not all(
+            os.path.exists(os.path.join(path, f'{key}.npy'))
+            for key in ARRAYS) or not os.path.exists(stamp_path):
+        return False
+    with open(stamp_path) as f:
+        stamp = json.load(f)
+    if stamp.get('version') != _version(weights):
+        return False
+    stored = stamp.get('sources', {})
+    current = _source_stamps(state, weights, hashes=False)
+    if any(f not in stored for f in current):
+        return False
+    if all(stored[f]['mtime'] == current[f]['mtime'] for f in current):
+        return True
+
+    current = _source_stamps(state, weights)
+    if any(stored[f]['sha256'] != current[f]['sha256'] for f in current):
+        return False
+    # only the modification times changed, so record them
+    _write_stamp(state, weights, {**stored, **current})
+    return True
+
+
+def load_atlas(state, weights='POP10'):
+    '''
+    Load the sampling atlas for a state as memory-mapped arrays, building it
+        first if it is missing or out of date
+    '''
+    path = _atlas_path(state, weights)
+    if not _has_atlas(state, weights):
+        print(f'Building {weights} sampling atlas for {state.name}')
+        build_atlas(state, weights)
+    return {
+        key: np.load(os.path.join(path, f'{key}.npy'), mmap_mode='r')
+        for key in ARRAYS
+    }
+
+
+def sample_atlas(atlas, n, rng):
+    '''
+    Draw n population weighted points from a loaded atlas. Returns an array
+        of (x, y) coordinates and the GEOID of each point's block.
+    '''
+    blocks = alias_draw(atlas['prob'], atlas['alias'], n, rng)
+    coords = draw_in_triangles(atlas['vertices'], atlas['cum_areas'],
+                               atlas['starts'], atlas['ends'], blocks, rng)
+    return coords, np.asarray(atlas['geoid'][blocks])
+
+
+def _load_states(states, weights='POP10', workers=1):
+    '''
+    Load the atlases for the given states, building missing or out of date
+        ones first (in parallel processes if workers > 1). Returns the
+        normalized states, their atlases and each state's share of the total
+        weight.
+    '''
+    states = census._normalize_states(states)
+    missing = [state for state in states if not _has_atlas(state, weights)]
+    if workers > 1 and len(missing) > 1:
+        print(f'Building {weights} sampling atlases for ' +
+              ', '.join(state.name for state in missing))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(build_atlas, missing, [weights] * len(missing)))
+    atlases = [load_atlas(state, weights) for state in states]
+    totals = np.array([atlas['total'][0] for atlas in atlases])
+    return states, atlases, totals / totals.sum()
+
+
+def _sample_loaded(atlases, shares, n, rng):
+    '''Draw n points across loaded atlases, shuffled between states'''
+    counts = rng.multinomial(n, shares)
+    samples = [
+        sample_atlas(atlas, count, rng)
+        for atlas, count in zip(atlases, counts)
+    ]
+    order = rng.permutation(n)
+    coords = np.concatenate([s[0] for s in samples])[order]
+    geoid = np.concatenate([s[1] for s in samples])[order]
+    return coords, geoid
+
+
+def sample_states(states, n, weights='POP10', seed=None, workers=1):
+    '''
+    Draw n population weighted points across the given states using their
+        atlases. Returns an array of (x, y) coordinates, the GEOID of each
+        point's block, and a list of abbreviations for all states used.
+        Missing atlases are built first, in parallel processes if workers > 1.
+    '''
+    states, atlases, shares = _load_states(states, weights, workers)
+    rng = np.random.default_rng(seed)
+    coords, geoid = _sample_loaded(atlases, shares, n, rng)
+    return coords, geoid, [st.abbr for st in states]
+
+
+def stream_states(states,
+                  n,
+                  weights='POP10',
+                  seed=None,
+                  chunk_size=100000,
+                  workers=1):
+    '''
+    Draw n population weighted points across the given states in chunks of
+        at most chunk_size, so memory use doesn't grow with n. Returns a list
+        of abbreviations for all states used and a generator of
+        (coordinates, GEOIDs) for each chunk.
+    '''
+    states, atlases, shares = _load_states(states, weights, workers)
+    rng = np.random.default_rng(seed)
+
+    def chunks():
+        for start in range(0, n, chunk_size):
+            size = min(chunk_size, n - start)
+            yield _sample_loaded(atlases, shares, size, rng)
+
+    return [st.abbr for st in states], chunks()
+
+
+def allocate(n, shares):
+    '''
+    Split n into integer counts proportional to shares, giving the remainder
+        to the largest fractional parts
+    '''
+    exact = n * np.asarray(shares, dtype=float)
+    counts = np.floor(exact).astype(int)
+    remainder = n - counts.sum()
+    counts[np.argsort(counts - exact, kind='stable')[:remainder]] += 1
+    return counts
+
+
+def stratified_states(states,
+                      n,
+                      weights='POP10',
+                      seed=None,
+                      level='county',
+                      sobol=False,
+                      workers=1):
+    '''
+    Draw n points across the given states, allocating them to counties or
+        tracts (level) in proportion to weight and drawing blocks and points
+        within each stratum. With sobol=True, points within each stratum come
+        from a scrambled Sobol sequence instead of independent draws.
+        Returns an array of (x, y) coordinates, the GEOID of each point's
+        block, each point's stratum, the weight each point represents, and a
+        list of abbreviations for all states used.
+    '''
+    states, atlases, _ = _load_states(states, weights, workers)
+    rng = np.random.default_rng(seed)
+
+    # every block across states, ordered by stratum then GEOID
+    geoid = np.concatenate([np.asarray(a['geoid']) for a in atlases])
+    block_weights = np.concatenate([np.asarray(a['weights']) for a in atlases])
+    source = np.repeat(np.arange(len(atlases)),
+                       [len(a['geoid']) for a in atlases])
+    local = np.concatenate([np.arange(len(a['geoid'])) for a in atlases])
+    order = np.argsort(geoid, kind='stable')
+    geoid, block_weights = geoid[order], block_weights[order]
+    source, local = source[order], local[order]
+    keys, first = np.unique(geoid // STRATA[level], return_index=True)
+    cum_weights = np.cumsum(block_weights)
+    offsets = np.concatenate([[0], cum_weights])[first]
+    totals = np.diff(np.concatenate([offsets, [cum_weights[-1]]]))
+
+    counts = allocate(n, totals / totals.sum())
+    if sobol:
+        # a separately scrambled sequence for each stratum
+        uniforms = np.concatenate([
+            qmc.Sobol(4, scramble=True, seed=rng).random_base2(
+                int(np.ceil(np.log2(count))))[:count]
+            for count in counts[counts > 0]
+        ])
+    else:
+        uniforms = rng.random((n, 4))
+    stratum = np.repeat(np.arange(len(keys)), counts)
+    targets = offsets[stratum] + uniforms[:, 0] * totals[stratum]
+    block = np.searchsorted(cum_weights, targets, side='right')
+    block = np.minimum(block, len(geoid) - 1)
+
+    coords = np.empty((n, 2))
+    for i, atlas in enumerate(atlases):
+        here = source[block] == i
+        coords[here] = draw_in_triangles(atlas['vertices'],
+                                         atlas['cum_areas'],
+                                         atlas['starts'],
+                                         atlas['ends'],
+                                         local[block[here]],
+                                         rng,
+                                         uniforms=uniforms[here, 1:])
+    represents = (totals / counts.clip(min=1))[stratum]
+    order = rng.permutation(n)
+    return (coords[order], geoid[block][order], keys[stratum][order],
+            represents[order], [st.abbr for st in states])
@@ -0,0 +1,223 @@
+'''Persistent on-disk caches of Google Maps and geocoding results'''
+import os
+import re
+import json
+import time
+import datetime
+import sqlite3
+import threading
+import numpy as np
+
+CACHE_DIR = os.path.join('data', 'cache')
+if not os.path.isdir(CACHE_DIR):
+    os.makedirs(CACHE_DIR)
+TRAVEL_TIME_DB = os.path.join(CACHE_DIR, 'travel_times.sqlite')
+GEOCODE_DB = os.path.join(CACHE_DIR, 'geocodes.sqlite')
+
+# Coordinates are rounded to 4 decimal places (about 10 meters) for keys
+COORD_DECIMALS = 4
+# Departure times within the same 15 minutes of the same kind of day share
+#   traffic results
+BUCKET_MINUTES = 15
+DEFAULT_TTL = datetime.timedelta(days=180)
+# Hospitals rarely move, so geocodes are kept longer
+GEOCODE_TTL = datetime.timedelta(days=365)
+
+
+def departure_bucket(departure_time=None):
+    '''
+    Get the cache bucket for a departure time given as a unix timestamp,
+        or 'none' for results without traffic
+    '''
+    if departure_time is None:
+        return 'none'
+    depart = datetime.datetime.fromtimestamp(departure_time)
+    day = 'weekend' if depart.weekday() >= 5 else 'weekday'
+    minute = depart.minute - depart.minute % BUCKET_MINUTES
+    return f'{day}-{depart.hour:02d}:{minute:02d}'
+
+
+def _coord_key(loc):
+    '''Integer key for a (lat, lng) pair'''
+    scale = 10**COORD_DECIMALS
+    return int(round(loc[0] * scale)), int(round(loc[1] * scale))
+
+
+def normalize_search_term(searchterm):
+    '''
+    Lowercase a geocoding search term and drop punctuation and extra spaces,
+        so trivially different spellings of the same hospital share a key
+    '''
+    return ' '.join(re.sub(r'[^\w\s]', ' ', str(searchterm).lower()).split())
+
+
+class _SQLiteCache:
+    '''
+    Shared connection, locking and hit counting for the SQLite caches.
+        Entries older than ttl are ignored.
+    '''
+    name = 'SQLite'
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+
+    def _oldest(self):
+        return time.time() - self.ttl.total_seconds()
+
+    def stats(self):
+        '''Hit and miss counts since this cache was opened'''
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else np.nan
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': rate}
+
+    def __str__(self):
+        stats = self.stats()
+        return (f"{self.name} cache: {stats['hits']} hits, " +
+                f"{stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)")
+
+
+class TravelTimeCache(_SQLiteCache):
+    '''
+    SQLite store of Distance Matrix elements keyed by rounded origin and
+        destination coordinates, travel mode, and departure time bucket.
+        Entries older than ttl are ignored and evicted.
+    '''
+    name = 'Travel time'
+
+    def __init__(self, path=TRAVEL_TIME_DB, ttl=DEFAULT_TTL):
+        super().__init__(path, ttl)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS elements (
+                origin_lat INTEGER, origin_lng INTEGER,
+                dest_lat INTEGER, dest_lng INTEGER,
+                mode TEXT, bucket TEXT,
+                dest_id TEXT,
+                duration REAL, traffic REAL, status TEXT,
+                created REAL,
+                PRIMARY KEY (origin_lat, origin_lng, dest_lat, dest_lng,
+                             mode, bucket))''')
+        self.evict()
+
+    def get(self, pairs, mode='driving', bucket='none'):
+        '''
+        Look up a list of (origin, destination) pairs of (lat, lng) tuples.
+            Returns a dict from position in pairs to a
+            (duration, traffic, status) tuple for the pairs found.
+        '''
+        query = '''SELECT duration, traffic, status FROM elements
+                   WHERE origin_lat=? AND origin_lng=? AND dest_lat=?
+                   AND dest_lng=? AND mode=? AND bucket=? AND created>=?'''
+        oldest = self._oldest()
+        found = {}
+        with self._lock:
+            for i, (origin, destination) in enumerate(pairs):
+                row = self._conn.execute(
+                    query, (*_coord_key(origin), *_coord_key(destination),
+                            mode, bucket, oldest)).fetchone()
+                if row is not None:
+                    duration, traffic, status = row
+                    found[i] = (np.nan if duration is None else duration,
+                                np.nan if traffic is None else traffic,
+                                status)
+        self.hits += len(found)
+        self.misses += len(pairs) - len(found)
+        return found
+
+    def put(self, pairs, elements, mode='driving', bucket='none',
+            dest_ids=None):
+        '''
+        Store (duration, traffic, status) elements for a list of
+            (origin, destination) pairs, optionally recording hospital IDs
+        '''
+        if dest_ids is None:
+            dest_ids = [None] * len(pairs)
+        now = time.time()
+        rows = []
+        for (origin, destination), dest_id, element in zip(
+                pairs, dest_ids, elements):
+            duration, traffic, status = element
+            rows.append((*_coord_key(origin), *_coord_key(destination), mode,
+                         bucket, None if dest_id is None else str(dest_id),
+                         None if np.isnan(duration) else float(duration),
+                         None if np.isnan(traffic) else float(traffic),
+                         status, now))
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO elements VALUES ' +
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def evict(self):
+        '''Delete entries older than the cache's ttl'''
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM elements WHERE created<?',
+                               (self._oldest(), ))
+
+
+class GeocodeCache(_SQLiteCache):
+    '''
+    SQLite store of geocoding results keyed by normalized search term and
+        provider (e.g. 'google' or 'mapbox'), holding every candidate the
+        provider returned and the one chosen (None if nothing suitable was
+        found). Entries older than ttl are ignored, so they're looked up again
+        and replaced.
+    '''
+    name = 'Geocode'
+
+    def __init__(self, path=GEOCODE_DB, ttl=GEOCODE_TTL):
+        super().__init__(path, ttl)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS geocodes (
+                term TEXT, provider TEXT,
+                candidates TEXT, chosen TEXT,
+                created REAL,
+                PRIMARY KEY (term, provider))''')
+
+    def get(self, searchterm, provider='google'):
+        '''
+        Look up a search term. Returns a (candidates, chosen) tuple, or None
+            if there's no entry newer than the cache's ttl.
+        '''
+        with self._lock:
+            row = self._conn.execute(
+                '''SELECT candidates, chosen FROM geocodes
+                   WHERE term=? AND provider=? AND created>=?''',
+                (normalize_search_term(searchterm), provider,
+                 self._oldest())).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put(self, searchterm, candidates, chosen, provider='google'):
+        '''Store the candidates and chosen result for a search term'''
+        row = (normalize_search_term(searchterm), provider,
+               json.dumps(candidates), json.dumps(chosen), time.time())
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?)', row)
+
+
+_travel_time_cache = None
+_geocode_cache = None
+
+
+def get_travel_time_cache():
+    '''Get the shared travel time cache, opening it on first use'''
+    global _travel_time_cache
+    if _travel_time_cache is None:
+        _travel_time_cache = TravelTimeCache()
+    return _travel_time_cache
+
+
+def get_geocode_cache():
+    '''Get the shared geocode cache, opening it on first use'''
+    global _geocode_cache
+    if _geocode_cache is None:
+        _geocode_cache = GeocodeCache()
+    return _geocode_cache
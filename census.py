@@ -1,10 +1,16 @@
 '''Download and read population files from the 2010 census.'''
 import os
+import json
 import string
+import hashlib
 import zipfile
 import warnings
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 import us
 import download
 from pathlib import Path
@@ -18,65 +24,358 @@ if not CENSUS_SUMMARYFILE_PATH.exists():
 
 if not os.path.isdir(CENSUS_FOLDER):
     os.makedirs(CENSUS_FOLDER)
+# Typed GeoParquet copies of block shapefiles and summary files
+PARQUET_FOLDER = os.path.join(CENSUS_FOLDER, 'parquet')
+if not os.path.isdir(PARQUET_FOLDER):
+    os.makedirs(PARQUET_FOLDER)
+GEOID_COLUMNS = ['GEOID10', 'BLOCKID10', 'GEO.id2']
 
 
-def read_states(states=['Connecticut']):
+def read_states(states=['Connecticut'], workers=1):
     '''
     Get census data for given states, downloading it if necessary.
         States can be passed by name, abbreviation, or FIPS code
-        Returns data and a list of abbreviations for all states used
+        Returns data and a list of abbreviations for all states used.
+        With workers > 1, states are read in parallel processes.
     '''
     states = _normalize_states(states)
-    files = []
-    for state in states:
-        d = _get_path(state)
-        if not os.path.isdir(d):
-            _download_data(state)
-        files_found = 0
-        for f in os.listdir(d):
-            if f.endswith('.shp'):
-                files.append(os.path.join(d, f))
-                files_found += 1
-        if files_found == 0:
-            mes = f'No data found for {state.name}.'
-            mes += f'\n\tDelete `{_get_path(state)}`'
-            mes += ' and run again to redownload'
-            warnings.warn(mes)
-    sub_dfs = [gpd.read_file(f) for f in files]
+    sub_dfs = _map_states(_read_state, states, workers)
     return pd.concat(sub_dfs), [st.abbr for st in states]
 
 
-def read_states_age_adjusted(states=['New York']):
+def _read_state(abbr):
+    '''Read the 2010 population blocks for one state'''
+    state = _normalize_states([abbr])[0]
+    d = _get_path(state)
+    if not os.path.isdir(d):
+        _download_data(state)
+    files = [os.path.join(d, f) for f in os.listdir(d) if f.endswith('.shp')]
+    if not files:
+        mes = f'No data found for {state.name}.'
+        mes += f'\n\tDelete `{_get_path(state)}`'
+        mes += ' and run again to redownload'
+        warnings.warn(mes)
+        return None
+    return pd.concat([_read_shapefile(f) for f in files])
+
+
+def read_states_age_adjusted(states=['New York'],
+                             workers=1,
+                             columns=[],
+                             weights=['over_65']):
+    '''
+    Get TIGER 2018 block geometry joined to registered weights (over_65 by
+        default) from the summary files for the given states. Only GEOID10,
+        STATEABBR, the weights and geometry are read, plus any summary file
+        columns listed in columns. Returns data and a list of abbreviations
+        for all states used
+    '''
     print(f"States entered: {', '.join(states)}")
     states = _normalize_states(states)
     state_abbrs = [st.abbr for st in states]
     print(f"States to read: {', '.join(state_abbrs)}")
-    dflist = []
-    gdflist = []
-    for state in states:
-        spath = CENSUS_SUMMARYFILE_PATH / f'{state.abbr}_blocks_from_all_counties.csv'
-        if not spath.exists():
-            print(f"{spath} dont exist so skip {state.abbr}")
-            continue
-        print(f"Reading {spath}")
-        dflist.append(
-            pd.read_csv(spath, dtype=str,
-                        skiprows=[1]).assign(STATEABBR=state.abbr))
-        gpath = SHAPEFILE_PATH / f'tl_2018_{state.fips}_tabblock10.shp'
-        print(f"Reading {gpath}")
-        gdflist.append(gpd.read_file(gpath))
-    dfs = pd.concat(dflist, ignore_index=True)
-    gdfs = gpd.GeoDataFrame(pd.concat(gdflist, ignore_index=True))
-    # Age group columns of 65 years or older for male and female
-    male_count_columns = [f'D{str(x).zfill(3)}' for x in range(20, 25 + 1)]
-    female_count_columns = [f'D{str(x).zfill(3)}' for x in range(44, 49 + 1)]
-    dfs['over_65'] = dfs[male_count_columns +
-                         female_count_columns].astype(int).sum(axis=1)
-    print("Combining shapefiles and population counts")
-    outdfs=gdfs.merge(dfs, right_on='GEO.id2', left_on='GEOID10')
+    read = partial(_read_state_age_adjusted,
+                   columns=columns,
+                   weights=weights)
+    sub_dfs = _map_states(read, states, workers)
+    outdfs = gpd.GeoDataFrame(pd.concat(sub_dfs, ignore_index=True))
+    outdfs['STATEABBR'] = outdfs.STATEABBR.astype('category')
     return outdfs, state_abbrs
 
 
+def _read_state_age_adjusted(abbr, columns=[], weights=['over_65']):
+    '''
+    Read the TIGER 2018 blocks for one state joined to its summary file
+        population counts, reading only the columns needed
+    '''
+    state = _normalize_states([abbr])[0]
+    spath = CENSUS_SUMMARYFILE_PATH / f'{state.abbr}_blocks_from_all_counties.csv'
+    if not spath.exists():
+        print(f"{spath} dont exist so skip {state.abbr}")
+        return None
+    print(f"Reading {spath}")
+    dfs = _read_summary(spath,
+                        columns=['GEO.id2'] + list(columns) + list(weights))
+    dfs = dfs.rename(columns={'GEO.id2': 'GEOID10'})
+    dfs['STATEABBR'] = state.abbr
+    gpath = SHAPEFILE_PATH / f'tl_2018_{state.fips}_tabblock10.shp'
+    print(f"Reading {gpath}")
+    gdfs = _read_shapefile(gpath, columns=['GEOID10'])
+    print(f"Combining shapefiles and population counts for {state.abbr}")
+    return gdfs.merge(dfs, on='GEOID10')
+
+
+def _map_states(read, states, workers=1):
+    '''
+    Apply a per-state read function to each state, skipping states with no
+        data. With workers > 1 the reads run in a pool of processes, which
+        send geometry back as WKB rather than pickled shapely objects.
+    '''
+    abbrs = [state.abbr for state in states]
+    if workers > 1 and len(abbrs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            packed = list(pool.map(_read_packed, [read] * len(abbrs), abbrs))
+        results = [_unpack(data) for data in packed]
+    else:
+        results = [read(abbr) for abbr in abbrs]
+    return [data for data in results if data is not None]
+
+
+def _read_packed(read, abbr):
+    '''Run a per-state read in a worker, encoding any geometry as WKB'''
+    data = read(abbr)
+    if not isinstance(data, gpd.GeoDataFrame):
+        return data, None, None
+    column = data.geometry.name
+    packed = pd.DataFrame(data)
+    packed[column] = shapely.to_wkb(data.geometry.values)
+    return packed, column, data.crs
+
+
+def _unpack(packed):
+    '''Rebuild the output of a per-state read from _read_packed'''
+    data, column, crs = packed
+    if column is None:
+        return data
+    geometry = gpd.GeoSeries.from_wkb(data.pop(column), crs=crs)
+    return gpd.GeoDataFrame(data, geometry=geometry.rename(column))
+
+
+def _block_shapefile(state, weights):
+    '''
+    Get the block shapefile for a state and the name of its block ID column.
+        Registered weights use the TIGER 2018 blocks matching the summary
+        files, other weights (POP10) use the 2010 population blocks.
+    '''
+    if weights in WEIGHTS:
+        path = SHAPEFILE_PATH / f'tl_2018_{state.fips}_tabblock10.shp'
+        return path, 'GEOID10'
+    d = _get_path(state)
+    if not os.path.isdir(d):
+        _download_data(state)
+    shapefiles = [f for f in os.listdir(d) if f.endswith('.shp')]
+    if not shapefiles:
+        raise FileNotFoundError(f'No data found for {state.name} in {d}')
+    return os.path.join(d, shapefiles[0]), 'BLOCKID10'
+
+
+# Age bands of the sex by age tables (SF1 P12 and ACS B01001) in table
+#   order, each as (youngest, oldest) with None for no upper limit
+AGE_BANDS = [(0, 4), (5, 9), (10, 14), (15, 17), (18, 19), (20, 20), (21, 21),
+             (22, 24), (25, 29), (30, 34), (35, 39), (40, 44), (45, 49),
+             (50, 54), (55, 59), (60, 61), (62, 64), (65, 66), (67, 69),
+             (70, 74), (75, 79), (80, 84), (85, None)]
+# Column number of the first male and female age band in each table, and the
+#   format of its column names
+AGE_TABLES = {
+    'sf1': {'male': 3, 'female': 27, 'column': 'D{:03d}'},
+    'acs': {'male': 3, 'female': 27, 'column': 'HD01_VD{:02d}'},
+}
+# Registered weights, by name, as (youngest, oldest, sexes)
+WEIGHTS = {}
+
+
+def register_weight(name, youngest=0, oldest=None, sexes=('male', 'female')):
+    '''
+    Register a population weight counting people of the given sexes between
+        youngest and oldest (inclusive, None for no limit). The ages must
+        fall on the edges of the census age bands in AGE_BANDS. Registered
+        weights are computed for every summary file and can be used as the
+        weights for generating points.
+    '''
+    if youngest not in [low for low, _ in AGE_BANDS]:
+        raise ValueError(f'{youngest} is not the youngest age of a band')
+    if oldest not in [high for _, high in AGE_BANDS] or (
+            oldest is not None and oldest < youngest):
+        raise ValueError(f'{oldest} is not the oldest age of a band ' +
+                         f'at or above {youngest}')
+    WEIGHTS[name] = (youngest, oldest, tuple(sexes))
+
+
+register_weight('total')
+register_weight('over_60', 60)
+register_weight('over_65', 65)
+register_weight('over_75', 75)
+register_weight('over_85', 85)
+
+
+def weight_columns(name, table='sf1'):
+    '''Get the columns of a sex by age table summed for a weight'''
+    youngest, oldest, sexes = WEIGHTS[name]
+    layout = AGE_TABLES[table]
+    bands = [
+        i for i, (low, high) in enumerate(AGE_BANDS)
+        if low >= youngest and (oldest is None or
+                                (high is not None and high <= oldest))
+    ]
+    return [
+        layout['column'].format(layout[sex] + i) for sex in sexes
+        for i in bands
+    ]
+
+
+def compute_weights(summary, table='sf1', names=None):
+    '''
+    Compute registered weights (all of them by default) for a sex by age
+        table in one matrix product. Returns an int32 dataframe with a
+        column for each weight.
+    '''
+    if names is None:
+        names = list(WEIGHTS)
+    columns = sorted(
+        {column
+         for name in names for column in weight_columns(name, table)})
+    position = {column: i for i, column in enumerate(columns)}
+    bands = np.zeros((len(columns), len(names)), dtype=np.int32)
+    for j, name in enumerate(names):
+        for column in weight_columns(name, table):
+            bands[position[column], j] = 1
+    counts = summary[columns].to_numpy(dtype=np.int32) @ bands
+    return pd.DataFrame(counts, columns=names, index=summary.index)
+
+
+def _weights_version():
+    '''Identifies the registered weights, so cached summaries can be redone'''
+    return json.dumps(sorted(WEIGHTS.items()))
+
+
+def read_block_weights(states=['New York'], weights='over_65', workers=1):
+    '''
+    Get the weight of every block in the given states without reading any
+        block geometry. Returns a dataframe indexed by block GEOID with
+        columns for the state abbreviation, county FIPS code and weight, and
+        a list of abbreviations for all states used
+    '''
+    states = _normalize_states(states)
+    tables = _map_states(partial(_read_state_weights, weights=weights), states,
+                         workers)
+    blocks = pd.concat(tables, ignore_index=True).set_index('GEOID')
+    return blocks, [st.abbr for st in states]
+
+
+def _read_state_weights(abbr, weights='over_65'):
+    '''Read block IDs and weights for one state'''
+    state = _normalize_states([abbr])[0]
+    if weights in WEIGHTS:
+        spath = CENSUS_SUMMARYFILE_PATH / f'{state.abbr}_blocks_from_all_counties.csv'
+        table = _read_summary(spath, columns=['GEO.id2', weights])
+        table = table.rename(columns={'GEO.id2': 'GEOID'})
+    else:
+        path, id_col = _block_shapefile(state, weights)
+        table = _read_shapefile(path,
+                                columns=[id_col, weights],
+                                geometry=False)
+        table = table.rename(columns={id_col: 'GEOID'})
+    table['state'] = state.abbr
+    table['county'] = table.GEOID // 10**10 % 1000
+    return table
+
+
+def read_county_blocks(state, counties, weights='over_65'):
+    '''
+    Read block geometry for only the given counties (by 3 digit FIPS code)
+        of a state, from the shapefile matching the given weights. Returns a
+        geoseries of block geometry indexed by GEOID
+    '''
+    state = _normalize_states([state])[0]
+    path, id_col = _block_shapefile(state, weights)
+    counties = [f'{int(county):03d}' for county in counties]
+    data = _read_shapefile(path,
+                           columns=[id_col],
+                           filters=[('COUNTYFP10', 'in', counties)])
+    return data.set_index(id_col).geometry
+
+
+def _source_files(path):
+    '''Files whose changes should invalidate the cached copy of path'''
+    path = Path(path)
+    if path.suffix == '.shp':
+        return [path, path.with_suffix('.dbf')]
+    return [path]
+
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _parquet_cache(path, convert, version=''):
+    '''
+    Get the path to the parquet copy of a census file, creating it with
+        convert(path) if it doesn't exist, the source has changed, or the
+        version of the conversion differs. Sources are compared by
+        modification time, then by hash if that differs.
+    '''
+    cache = Path(PARQUET_FOLDER) / (Path(path).stem + '.parquet')
+    stamp_path = cache.with_suffix('.json')
+    sources = _source_files(path)
+    mtimes = {str(f): os.path.getmtime(f) for f in sources}
+    stamps = {}
+    if cache.exists() and stamp_path.exists():
+        with open(stamp_path) as f:
+            stamp = json.load(f)
+        if stamp.get('version') == version:
+            stamps = stamp.get('sources', {})
+    if set(stamps) == set(mtimes) and all(
+            stamps[f]['mtime'] == mtimes[f] for f in mtimes):
+        return cache
+
+    hashes = {f: _file_hash(f) for f in mtimes}
+    if set(stamps) != set(hashes) or any(
+            stamps[f]['sha256'] != hashes[f] for f in hashes):
+        print(f'Caching {path} as {cache}')
+        convert(path).to_parquet(cache)
+    sources = {f: {'mtime': mtimes[f], 'sha256': hashes[f]} for f in mtimes}
+    with open(stamp_path, 'w') as f:
+        json.dump({'version': version, 'sources': sources}, f)
+    return cache
+
+
+def _convert_shapefile(path):
+    '''Read a block shapefile with integer GEOIDs'''
+    data = gpd.read_file(path)
+    for column in GEOID_COLUMNS:
+        if column in data.columns:
+            data[column] = data[column].astype('int64')
+    return data
+
+
+def _convert_summary(path):
+    '''
+    Read a summary file with integer GEOIDs and int32 counts, adding a column
+        for every registered weight
+    '''
+    data = pd.read_csv(path, dtype=str, skiprows=[1])
+    for column in data.columns:
+        if column in GEOID_COLUMNS:
+            data[column] = data[column].astype('int64')
+        elif column.startswith('D') and column[1:].isdigit():
+            data[column] = data[column].astype('int32')
+    return pd.concat([data, compute_weights(data)], axis=1)
+
+
+def _read_shapefile(path, columns=None, filters=None, geometry=True):
+    '''
+    Read a block shapefile from its parquet cache, optionally reading only
+        some columns, rows matching pyarrow filters, or no geometry
+    '''
+    cache = _parquet_cache(path, _convert_shapefile)
+    if not geometry:
+        return pd.read_parquet(cache, columns=columns, filters=filters)
+    if columns is not None:
+        columns = columns + ['geometry']
+    return gpd.read_parquet(cache, columns=columns, filters=filters)
+
+
+def _read_summary(path, columns=None):
+    '''Read a summary file from its parquet cache'''
+    cache = _parquet_cache(path, _convert_summary, _weights_version())
+    return pd.read_parquet(cache, columns=columns)
+
+
 def _normalize_states(states):
     '''
     Convert states to standardized names
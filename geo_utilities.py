@@ -1,9 +1,8 @@
 '''Utility functions for dealing with locations and distances'''
-import itertools
 import pandas as pd
 import numpy as np
-import geopy.distance as geodist
 import datetime
+from sklearn.neighbors import BallTree
 import maps
 import requests
 
@@ -13,23 +12,270 @@ def extract_locations(data):
     return [list(x) for x in recs]
 
 
-def distance_matrix(row_locs, col_locs, row_names, col_names):
+# WGS-84 ellipsoid, the same one geopy uses for its geodesic distance
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+# Mean earth radius used by geopy.distance.great_circle
+EARTH_RADIUS_KM = 6371.009
+METERS_PER_MILE = 1609.344
+EARTH_RADIUS_MILES = EARTH_RADIUS_KM * 1000 / METERS_PER_MILE
+
+
+def _haversine(lat1, lng1, lat2, lng2):
+    '''Great circle distance in miles between arrays of coordinates'''
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = (np.sin((lat2 - lat1) / 2)**2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2)**2)
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def _vincenty(lat1, lng1, lat2, lng2, tol=1e-12, max_iter=200):
+    '''
+    Ellipsoidal distance in miles between arrays of coordinates, using
+        Vincenty's inverse formula on the WGS-84 ellipsoid. Pairs that fail
+        to converge (nearly antipodal points) fall back to haversine
+    '''
+    lat1, lng1, lat2, lng2 = np.broadcast_arrays(lat1, lng1, lat2, lng2)
+    f = WGS84_F
+    L = np.radians(lng2 - lng1)
+    U1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = L
+    converged = np.zeros(L.shape, dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(cosU2 * sin_lam,
+                                 cosU1 * sinU2 - sinU1 * cosU2 * cos_lam)
+            cos_sigma = sinU1 * sinU2 + cosU1 * cosU2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0,
+                                 cosU1 * cosU2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha**2
+            # equatorial lines have cos2_alpha == 0
+            cos_2sm = np.where(cos2_alpha == 0, 0,
+                               cos_sigma - 2 * sinU1 * sinU2 / cos2_alpha)
+            C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C) * f * sin_alpha * (
+                sigma + C * sin_sigma *
+                (cos_2sm + C * cos_sigma * (-1 + 2 * cos_2sm**2)))
+            converged = np.abs(lam - lam_prev) < tol
+            if converged.all():
+                break
+
+        u2 = cos2_alpha * (WGS84_A**2 - WGS84_B**2) / WGS84_B**2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sm + B / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sm**2) - B / 6 * cos_2sm *
+            (-3 + 4 * sin_sigma**2) * (-3 + 4 * cos_2sm**2)))
+        dist = WGS84_B * A * (sigma - delta_sigma) / METERS_PER_MILE
+
+    if not converged.all():
+        fallback = _haversine(lat1, lng1, lat2, lng2)
+        dist = np.where(converged, dist, fallback)
+    return dist
+
+
+DISTANCE_METHODS = {
+    'haversine': _haversine,
+    'vincenty': _vincenty,
+}
+
+
+def distances(row_locs, col_locs, method='vincenty'):
+    '''
+    Get an array of straight line distances in miles between every pair of
+        row and column locations
+        row_locs, col_locs -- lists of (lat, lng) tuples
+        method -- 'vincenty' for ellipsoidal distances (within a few
+            millimeters of geopy.distance.distance) or 'haversine' for faster
+            great circle distances (within about 0.5% of geopy)
+    '''
+    try:
+        kernel = DISTANCE_METHODS[method]
+    except KeyError:
+        raise ValueError(f"Unknown distance method '{method}'")
+    rows = np.asarray(row_locs, dtype=float).reshape(-1, 2)
+    cols = np.asarray(col_locs, dtype=float).reshape(-1, 2)
+    return kernel(rows[:, [0]], rows[:, [1]], cols[:, 0], cols[:, 1])
+
+
+def cutoff(min_dist):
+    '''
+    Distance within which locations count as "nearby", given the distance to
+        the closest location
+    '''
+    return np.maximum(min_dist * 1.5, min_dist + 30)
+
+
+def distance_matrix(row_locs, col_locs, row_names, col_names,
+                    method='vincenty'):
     '''
     Get straight line distances between locations, along with a cutoff value
         for each row which can be used to define "nearby" locations for that
         row, relative to the closest location
         row_locs, col_locs -- lists of (lat, lng) tuples
         row_names, col_names -- indices identifying locations
+        method -- distance calculation, see `distances`
     '''
-    dist_vals = [geodist.distance(l1, l2).miles
-                 for l1, l2 in itertools.product(row_locs, col_locs)]
-    dist_vals = np.reshape(dist_vals, (len(row_locs), len(col_locs)))
+    dist_vals = distances(row_locs, col_locs, method=method)
     out = pd.DataFrame(dist_vals, columns=col_names, index=row_names)
-    out['Min_dist'] = out.min(axis=1)
-    out['Cutoff'] = out.Min_dist.apply(lambda m: max(m * 1.5, m + 30))
-    out = out.drop(columns='Min_dist')
+    min_dist = (dist_vals.min(axis=1) if dist_vals.shape[1] else
+                np.full(dist_vals.shape[0], np.nan))
+    out['Cutoff'] = cutoff(min_dist)
     return out
 
+# Approximate length of a degree of latitude
+METERS_PER_DEGREE = 111320
+
+
+def snap_points(points, resolution):
+    '''
+    Group points with Latitude and Longitude into grid cells roughly
+        `resolution` meters on a side. Returns a series mapping the index of
+        each point to the index of the representative for its cell, which is
+        the first point in that cell.
+    '''
+    lat = points.Latitude.to_numpy(dtype=float)
+    lng = points.Longitude.to_numpy(dtype=float)
+    cell_size = resolution / METERS_PER_DEGREE
+    row = np.floor(lat / cell_size)
+    # keep cells roughly square by narrowing them in longitude with latitude
+    row_center = np.radians((row + 0.5) * cell_size)
+    col = np.floor(lng * np.cos(row_center) / cell_size)
+    ids = pd.Series(points.index, index=points.index)
+    return ids.groupby([row, col], sort=False).transform('first')
+
+
+# Working memory used per (row, column) pair while computing a block of
+#   distances, covering the temporaries of the Vincenty iteration
+_BYTES_PER_PAIR = 8 * 24
+DEFAULT_MAX_MEMORY = 512 * 2**20
+
+
+class NearbyDistances:
+    '''
+    Sparse (CSR) distances in miles from each row location to its "nearby"
+        column locations, stored as float32 and sorted closest first within
+        each row. Iterating gives one series per row, indexed by column name.
+    '''
+
+    def __init__(self, indptr, indices, distances, row_names, col_names):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.distances = np.asarray(distances, dtype=np.float32)
+        self.row_names = pd.Index(row_names)
+        self.col_names = pd.Index(col_names)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __iter__(self):
+        return (self.row(i) for i in range(len(self)))
+
+    def __getitem__(self, name):
+        return self.row(self.row_names.get_loc(name))
+
+    def row(self, i):
+        '''Distances for the row at position i'''
+        start, stop = self.indptr[i], self.indptr[i + 1]
+        return pd.Series(self.distances[start:stop],
+                         index=self.col_names[self.indices[start:stop]])
+
+    @property
+    def nbytes(self):
+        return (self.indptr.nbytes + self.indices.nbytes +
+                self.distances.nbytes)
+
+
+def _build_nearby(rows, cols, dists, n_rows, row_names, col_names):
+    '''Sort (row, col, distance) triples into a NearbyDistances'''
+    order = np.lexsort((dists, rows))
+    indptr = np.concatenate([[0],
+                             np.cumsum(np.bincount(rows, minlength=n_rows))])
+    return NearbyDistances(indptr, cols[order], dists[order], row_names,
+                           col_names)
+
+
+def nearby_distances(row_locs, col_locs, row_names, col_names,
+                     method='vincenty', max_memory=DEFAULT_MAX_MEMORY):
+    '''
+    Memory bounded alternative to `distance_matrix` for large sets of rows.
+        Distances are computed in blocks of rows sized so that the working
+        arrays stay under max_memory bytes, and only the "nearby" columns of
+        each row are kept, in a sparse NearbyDistances.
+    '''
+    rows = np.asarray(row_locs, dtype=float).reshape(-1, 2)
+    cols = np.asarray(col_locs, dtype=float).reshape(-1, 2)
+    block = max(1, int(max_memory // (max(len(cols), 1) * _BYTES_PER_PAIR)))
+
+    indptr = [np.zeros(1, dtype=np.int64)]
+    indices = [np.zeros(0, dtype=np.int64)]
+    data = [np.zeros(0, dtype=np.float32)]
+    for start in range(0, len(rows), block):
+        dists = distances(rows[start:start + block], cols, method=method)
+        keep = dists < cutoff(dists.min(axis=1))[:, None]
+        r, c = np.nonzero(keep)
+        d = dists[r, c]
+        order = np.lexsort((d, r))
+        indices.append(c[order])
+        data.append(d[order].astype(np.float32))
+        indptr.append(indptr[-1][-1] + np.cumsum(keep.sum(axis=1)))
+    return NearbyDistances(np.concatenate(indptr), np.concatenate(indices),
+                           np.concatenate(data), row_names, col_names)
+
+
+class HospitalIndex:
+    '''
+    Spatial index over a table of hospitals, built once and reused to find the
+        hospitals "nearby" any number of locations without computing distances
+        to every hospital (see `distance_matrix` for the cutoff definition)
+    '''
+    # Extra search radius to cover the gap between the great circle distances
+    #   used by the tree and the ellipsoidal distances used for the cutoff
+    RADIUS_SLACK = 0.02
+
+    def __init__(self, hospitals, method='vincenty'):
+        self.ids = hospitals.index
+        self.locs = np.asarray(extract_locations(hospitals), dtype=float)
+        self.method = method
+        self.tree = BallTree(np.radians(self.locs), metric='haversine')
+
+    def nearby(self, locs, names=None):
+        '''
+        Get the nearby hospitals for each of the given (lat, lng) locations,
+            as NearbyDistances with rows identified by names (defaulting to
+            positions) and columns by hospital
+        '''
+        locs = np.asarray(locs, dtype=float).reshape(-1, 2)
+        points = np.radians(locs)
+        nearest, _ = self.tree.query(points, k=1)
+        radius = cutoff(nearest[:, 0] * EARTH_RADIUS_MILES)
+        radius *= (1 + self.RADIUS_SLACK) / EARTH_RADIUS_MILES
+        candidates = self.tree.query_radius(points, radius)
+
+        counts = np.array([len(c) for c in candidates])
+        rows = np.repeat(np.arange(len(locs)), counts)
+        cols = np.concatenate(candidates).astype(int)
+        dists = DISTANCE_METHODS[self.method](locs[rows, 0], locs[rows, 1],
+                                              self.locs[cols, 0],
+                                              self.locs[cols, 1])
+        # the exact closest hospital is always among the candidates
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        min_dist = np.minimum.reduceat(dists, starts)
+        keep = dists < cutoff(min_dist)[rows]
+        if names is None:
+            names = pd.RangeIndex(len(locs))
+        return _build_nearby(rows[keep], cols[keep], dists[keep], len(locs),
+                             names, self.ids)
+
+
 def _to_gmap_coor(coors):
     return '|'.join([','.join([str(x) for x in y]) for y in coors])
 
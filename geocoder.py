@@ -0,0 +1,152 @@
+'''
+Offline hospital geocoding against a local reference table of hospitals with
+    known names, addresses and coordinates. Hospitals are only compared with
+    reference entries in the same ZIP code whose names have the same
+    distinctive words, and the closest of those by character trigrams is
+    taken, so differences in spelling, abbreviation and punctuation still find
+    the right hospital without confusing neighbouring ones.
+'''
+import os
+import re
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import TfidfVectorizer
+import cache
+
+# Pipe separated, like the master list, with at least the columns below
+REFERENCE_FILE = os.path.join('data', 'hospitals', 'reference.csv')
+REFERENCE_COLUMNS = ['Name', 'Address', 'Latitude', 'Longitude']
+# Lowest cosine similarity between trigram profiles of the names
+MIN_NAME_SCORE = 0.8
+# Number of search terms scored against the reference table at once
+BLOCK_SIZE = 1000
+
+ABBREVIATIONS = {
+    'st': 'saint',
+    'ste': 'sainte',
+    'mt': 'mount',
+    'hosp': 'hospital',
+    'med': 'medical',
+    'ctr': 'center',
+    'centre': 'center',
+    'univ': 'university',
+    'reg': 'regional',
+    'mem': 'memorial',
+}
+# Five digit ZIP code, with or without its +4 suffix
+ZIP_CODE = re.compile(r'\b(\d{5})(?:-?\d{4})?\b')
+# Words dropped from names, including the 's' left over from possessives
+#   once punctuation is removed
+STOP_WORDS = {'the', 'and', 'of', 'at', 'inc', 'llc', 's'}
+# Words shared by many hospitals, which only count towards the trigram score
+GENERIC_WORDS = {
+    'hospital', 'medical', 'center', 'health', 'healthcare', 'regional',
+    'memorial', 'community', 'general', 'system', 'campus'
+}
+
+
+def load_reference(reference_file=REFERENCE_FILE):
+    '''
+    Read the reference table of hospitals, dropping any without coordinates
+    '''
+    reference = pd.read_csv(reference_file, sep='|')
+    missing = [c for c in REFERENCE_COLUMNS if c not in reference.columns]
+    if missing:
+        raise ValueError(f'{reference_file} is missing columns {missing}')
+    has_location = reference[['Latitude', 'Longitude']].notnull().all(axis=1)
+    return reference[has_location].reset_index(drop=True)
+
+
+def _name_words(name):
+    '''Normalized words of a hospital name with abbreviations spelled out'''
+    words = cache.normalize_search_term(name).split()
+    words = [ABBREVIATIONS.get(w, w) for w in words]
+    return [w for w in words if w not in STOP_WORDS]
+
+
+def _distinctive(words):
+    '''
+    The set of non-generic words in a name as a string, ignoring plurals and
+        possessives (a trailing s), or None if there are none
+    '''
+    words = {
+        w[:-1] if len(w) > 3 and w.endswith('s') else w
+        for w in words if w not in GENERIC_WORDS
+    }
+    return ' '.join(sorted(words)) if words else None
+
+
+def _zip_code(place):
+    '''The five digit ZIP code at the end of an address (or ZIP+4), or None'''
+    codes = ZIP_CODE.findall(place)
+    return codes[-1] if codes else None
+
+
+def _keys(names, places):
+    '''
+    Blocking key for each hospital: its ZIP code and the distinctive words in
+        its name, or None if either is missing
+    '''
+    words = _strings(names).map(_name_words)
+    zips = _strings(places).map(_zip_code)
+    return [
+        None if z is None or d is None else f'{z}|{d}'
+        for z, d in zip(zips, words.map(_distinctive))
+    ], words.map(' '.join)
+
+
+def _strings(values):
+    return pd.Series(values).fillna('').astype(str)
+
+
+class ReferenceIndex:
+    '''
+    Name index over a reference table of hospitals (see `load_reference`),
+        built once and used to match any number of hospitals against it
+    '''
+
+    def __init__(self, reference):
+        self.reference = reference.reset_index(drop=True)
+        keys, names = _keys(self.reference.Name, self.reference.Address)
+        self.keys = pd.Index(pd.unique(pd.Series(keys).dropna()))
+        self.key_matrix = self._one_hot(keys)
+        # rows are normalized, so dot products are cosine similarities
+        self.names = TfidfVectorizer(analyzer='char_wb', ngram_range=(3, 3))
+        self.name_matrix = self.names.fit_transform(names)
+
+    def _one_hot(self, keys):
+        '''Sparse indicator matrix of each row's blocking key'''
+        codes = self.keys.get_indexer(keys)
+        rows = np.flatnonzero(codes >= 0)
+        return csr_matrix((np.ones(len(rows)), (rows, codes[rows])),
+                          shape=(len(keys), len(self.keys)))
+
+    def match(self, names, places, min_name_score=MIN_NAME_SCORE):
+        '''
+        Find the reference hospital for each hospital name, given its place
+            as a string ending in its ZIP code. Only reference hospitals in
+            the same ZIP code with the same distinctive name words are
+            considered. Returns a dataframe indexed like names with the Name,
+            Address, Latitude, Longitude and Score of every match whose name
+            scores at least min_name_score.
+        '''
+        index = pd.Series(names).index
+        keys, texts = _keys(names, places)
+        same_key = self._one_hot(keys) @ self.key_matrix.T
+        queries = self.names.transform(texts)
+
+        best = np.zeros(len(keys), dtype=int)
+        scores = np.zeros(len(keys))
+        for start in range(0, len(keys), BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, len(keys))
+            sim = (queries[start:end] @ self.name_matrix.T).multiply(
+                same_key[start:end]).tocsr()
+            best[start:end] = np.asarray(sim.argmax(axis=1)).ravel()
+            scores[start:end] = sim.max(axis=1).toarray().ravel()
+
+        matched = scores >= min_name_score
+        out = self.reference.loc[best[matched], REFERENCE_COLUMNS]
+        out.index = index[matched]
+        out['Score'] = scores[matched]
+        return out
@@ -1,10 +1,18 @@
 '''Load, manipulate, and write hospital location files'''
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 import numpy as np
+import pyarrow as pa
 from tqdm import tqdm
 import download
 import maps
+import routing
 import geo_utilities as geo
+import cache
+import journal
+import geocoder
 from pathlib import Path
 import data_io
 
@@ -12,21 +20,102 @@ HOSPITAL_DIR = Path('data') / 'hospitals'
 if not HOSPITAL_DIR.exists(): HOSPITAL_DIR.mkdir()
 MASTER_LIST = HOSPITAL_DIR / 'all.csv'
 MASTER_LIST_OFFLINE = data_io.HOSPITAL_ADDY
+# Typed copies of hospital files, see `load_hospitals`
+HOSPITAL_CACHE_DIR = HOSPITAL_DIR / 'cache'
+# Changing the typed conversion should change this to rebuild cached copies
+TYPES_VERSION = 2
+CATEGORY_COLUMNS = ['CenterType', 'State']
+FLOAT32_COLUMNS = ['Latitude', 'Longitude']
+# Read as text so ZIP codes keep leading zeros. IDs keep their parsed type,
+#   so destinationID, the travel time files and hospital keys still match.
+STRING_COLUMNS = ['PostalCode']
 JC_URL = ("https://www.qualitycheck.org/file.aspx?FolderName=" +
           "StrokeCertification&c=1")
 
 
-def load_hospitals(hospital_file=MASTER_LIST_OFFLINE):
+def load_hospitals(hospital_file=MASTER_LIST_OFFLINE, typed=True):
     '''
-    Read in the given relative filepath as a table of hospital information
+    Read in the given relative filepath as a table of hospital information.
+        With typed=True, CenterType and State are categorical, coordinates
+        are float32 and Failed_Lookup is bool. The typed table is kept in
+        memory and as a Parquet copy in `HOSPITAL_CACHE_DIR`, both reused
+        until the file changes. Code that edits and saves the file should use
+        typed=False, which reads it as is at full precision.
     '''
     if hospital_file is None: hospital_file = MASTER_LIST_OFFLINE
-    hospitals = pd.read_csv(hospital_file, sep='|')
+    if not typed:
+        return _read_master_list(hospital_file)
+
+    path = Path(hospital_file).resolve()
+    stat = path.stat()
+    stamp = {
+        'source': str(path),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'version': TYPES_VERSION,
+    }
+    loaded = _loaded.get(str(path))
+    if loaded is None or loaded[0] != stamp:
+        loaded = (stamp, _typed_master_list(path, stamp))
+        _loaded[str(path)] = loaded
+    # callers may modify the table, so the memoized one is never handed out
+    return loaded[1].copy()
+
+
+_loaded = {}
+
+
+def _read_master_list(hospital_file):
+    '''Parse a hospital file, indexed by HOSP_ID if it has one'''
+    hospitals = pd.read_csv(hospital_file,
+                            sep='|',
+                            dtype={c: str for c in STRING_COLUMNS})
     if "HOSP_ID" in hospitals.columns:
         hospitals.set_index("HOSP_ID", inplace=True)
     return hospitals
 
 
+def _typed_master_list(path, stamp):
+    '''
+    Read the typed table for a hospital file from its Parquet copy, parsing
+        the file and replacing the copy if its stamp doesn't match
+    '''
+    key = hashlib.sha1(str(path).encode()).hexdigest()[:12]
+    cache_path = HOSPITAL_CACHE_DIR / f'{path.stem}-{key}.parquet'
+    stamp_path = cache_path.with_suffix('.json')
+    if cache_path.exists() and stamp_path.exists():
+        with open(stamp_path) as f:
+            if json.load(f) == stamp:
+                return pd.read_parquet(cache_path)
+
+    hospitals = _convert_types(_read_master_list(path))
+    HOSPITAL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        hospitals.to_parquet(cache_path)
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        # e.g. a column mixing numbers and text; only the memo is kept
+        print(f'Not caching {path}: {e}')
+        return hospitals
+    with open(stamp_path, 'w') as f:
+        json.dump(stamp, f)
+    return hospitals
+
+
+def _convert_types(hospitals):
+    '''Apply the typed loader's column types to a parsed hospital file'''
+    for column in CATEGORY_COLUMNS:
+        if column in hospitals.columns:
+            hospitals[column] = hospitals[column].astype('category')
+    for column in FLOAT32_COLUMNS:
+        if column in hospitals.columns:
+            hospitals[column] = hospitals[column].astype('float32')
+    if 'Failed_Lookup' in hospitals.columns:
+        # NaN and anything but true counts as not failed
+        failed = hospitals.Failed_Lookup.astype(str).str.lower()
+        hospitals['Failed_Lookup'] = failed == 'true'
+    return hospitals
+
+
 def _save_master_list(data, savedir=MASTER_LIST_OFFLINE):
     data.to_csv(savedir, sep='|')
 
@@ -39,7 +128,7 @@ def master_list_online(update=False):
     '''
 
     if MASTER_LIST.exists():
-        existing = load_hospitals(MASTER_LIST)
+        existing = load_hospitals(MASTER_LIST, typed=False)
     else:
         columns = [
             'CenterID', 'CenterType', 'OrganizationName', 'City', 'State',
@@ -100,21 +189,27 @@ def master_list_online(update=False):
     return out
 
 
-def update_locations(current=None):
+def update_locations(current=None, workers=1, use_cache=True,
+                     reference_file=geocoder.REFERENCE_FILE):
     '''
     Use google maps to find addresses and coordinates for any hospitals that
         don't yet have them, meaning all of 'Name', 'Address', 'Latitude', and
         'Longitude' are NaN. If any of these are filled the hospital will be
         skipped. To perform manual updates directly edit `all.csv`; the
         function `maps.get_hospital_location` can be used to manually generate
-        address and location from any search string.
+        address and location from any search string. Lookups run on
+        `workers` threads and are checkpointed to a journal next to the master
+        list, which is written once at the end. Hospitals are first matched
+        offline against the reference table in reference_file, if it exists
+        (see `geocoder`), and search terms already in the geocode cache
+        aren't looked up again.
     '''
     if current is None:
-        current = load_hospitals()
+        current = load_hospitals(typed=False)
         savedir = MASTER_LIST_OFFLINE
     else:
         savedir = current
-        current = load_hospitals(current)
+        current = load_hospitals(current, typed=False)
 
     loc_cols = ['Latitude', 'Longitude']
     no_data = current[loc_cols].isnull().all(axis=1)
@@ -126,22 +221,117 @@ def update_locations(current=None):
         print('No locations to update')
         return
 
-    client = maps.get_client()
-    for i in tqdm(to_update, desc='Getting Locations'):
-        orgname = current.OrganizationName[i]
-        address = current.Source_Address[i]
-        if not isinstance(address, str):  # interpet nan type
-            if str(address) == 'nan': address = ''
-        city = current.City[i]
-        state = current.State[i]
-        postal = current.PostalCode[i]
-
-        searchterm = ' '.join([orgname, address, city, state, postal])
+    journal_path = str(savedir) + '.journal'
+    # records for hospitals that have since been filled in are ignored, so
+    #   existing data is never overwritten
+    found = {
+        record['id']: record['results']
+        for record in journal.read(journal_path)
+        if record['id'] in to_update
+    }
+    pending = [i for i in to_update if i not in found]
+    if found:
+        print(f'Resuming with {len(found)} locations from {journal_path}')
+
+    if reference_file is not None and Path(reference_file).exists():
+        found.update(_match_reference(current, pending, reference_file))
+        pending = [i for i in pending if i not in found]
+
+    geocode_cache = cache.get_geocode_cache() if use_cache else None
+    if geocode_cache is not None:
+        # fill in anything we've already looked up before making requests
+        for i in pending:
+            results = maps.cached_hospital_location(_search_term(current, i),
+                                                    geocode_cache)
+            if results is not None:
+                found[i] = results
+        pending = [i for i in pending if i not in found]
+
+    error = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(_lookup_location, _search_term(current, i),
+                        geocode_cache): i
+            for i in pending
+        }
+        for future in tqdm(as_completed(futures),
+                           total=len(futures),
+                           desc='Getting Locations'):
+            i = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                # keep the lookups that finished and stop the rest
+                if error is None:
+                    error = e
+                    pool.shutdown(wait=False, cancel_futures=True)
+                continue
+            if not results:
+                tqdm.write(f"Found no results for {i}: " +
+                           f"'{_search_term(current, i)}'")
+            # checkpoint each result to minimize data loss on crash/cancel
+            journal.append(journal_path, [{'id': i, 'results': results}])
+            found[i] = results
+
+    _set_locations(current, found)
+    _save_master_list(current, savedir=savedir)
+    journal.remove(journal_path)
+    if error is not None:
+        raise error
+
+    if geocode_cache is not None:
+        print(geocode_cache)
+
+
+def _search_term(current, i):
+    '''Places search string for hospital i of the master list'''
+    orgname = current.OrganizationName[i]
+    address = current.Source_Address[i]
+    if not isinstance(address, str):  # interpet nan type
+        if str(address) == 'nan': address = ''
+    city = current.City[i]
+    state = current.State[i]
+    postal = str(current.PostalCode[i])
+
+    return ' '.join([orgname, address, city, state, postal])
+
+
+def _match_reference(current, ids, reference_file):
+    '''
+    Match the given master list entries against a reference table of
+        hospitals, returning location results for the entries that matched
+    '''
+    index = geocoder.ReferenceIndex(geocoder.load_reference(reference_file))
+    entries = current.loc[ids]
+    places = entries[['City', 'State', 'PostalCode']].fillna('').astype(str)
+    matches = index.match(entries.OrganizationName,
+                          places.agg(' '.join, axis=1))
+    print(f'Matched {len(matches)} of {len(ids)} locations in ' +
+          f'{reference_file}')
+    return {
+        i: match[geocoder.REFERENCE_COLUMNS].to_dict()
+        for i, match in matches.iterrows()
+    }
+
+
+def _lookup_location(searchterm, geocode_cache=None):
+    '''
+    Look up a hospital with the current thread's Google Maps client, storing
+        the result in the geocode cache
+    '''
+    return maps.get_hospital_location(searchterm, maps.get_thread_client(),
+                                      cache=geocode_cache, refresh=True)
 
-        results = maps.get_hospital_location(searchterm, client)
 
+def _set_locations(current, found):
+    '''
+    Store location lookup results (by hospital ID) in the master list, marking
+        hospitals with no results as failed lookups
+    '''
+    columns = ['Name', 'Address', 'Failed_Lookup']
+    current[columns] = current[columns].astype(object)
+    for i, results in found.items():
         if not results:
-            tqdm.write(f"Found no results for {i}: '{searchterm}'")
             current.loc[i, 'Failed_Lookup'] = True
         else:
             current.loc[i, 'Name'] = results['Name']
@@ -150,21 +340,25 @@ def update_locations(current=None):
             current.loc[i, 'Longitude'] = results['Longitude']
             current.loc[i, 'Failed_Lookup'] = False
 
-        # save after each iteration to minimize data loss on crash/cancel
-        _save_master_list(current, savedir=savedir)
-
 
-def update_transfer_destinations(data=None):
+def update_transfer_destinations(data=None, use_cache=True, backend=None,
+                                 batched=True, workers=1):
     '''
-    Use google maps to find transfer destinations for all primary hospitals
-        that don't yet have one stored. Doesn't overwrite any data.
+    Use google maps (or another `routing` backend) to find transfer
+        destinations for all primary hospitals that don't yet have one
+        stored. Doesn't overwrite any data. Travel times already in the
+        travel time cache aren't requested again. With batched=True, all
+        primaries are handled together in multi-origin requests (up to
+        `workers` in flight at once) and the master list is written once at
+        the end; otherwise each primary gets its own request and the master
+        list is saved after each one.
     '''
     if data is None:
-        data = load_hospitals()
+        data = load_hospitals(typed=False)
         savedir = MASTER_LIST_OFFLINE
     else:
         savedir = data
-        data = load_hospitals(data)
+        data = load_hospitals(data, typed=False)
 
     # only calculate info for hospitals we dont have data for yet
     no_destination = data[['destination', 'destinationID',
@@ -178,20 +372,36 @@ def update_transfer_destinations(data=None):
         print('No primaries to find transfer destinations for')
         return
 
+    # names and IDs are stored in columns that may have been read as all NaN
+    columns = ['destination', 'destinationID', 'transfer_time']
+    data[columns] = data[columns].astype(object)
     comp_data = data[data.CenterType == 'Comprehensive']
     prim_locs = geo.extract_locations(prim_to_update)
-    comp_locs = geo.extract_locations(comp_data)
-    distances = geo.distance_matrix(prim_locs, comp_locs, prim_to_update.index,
-                                    comp_data.index)
-
-    client = maps.get_client()
-    for i in tqdm(prim_to_update.index):
-        comps = distances.loc[i]
-        include = comps[comps < comps.Cutoff]
+    nearby = geo.HospitalIndex(comp_data).nearby(prim_locs)
+
+    if backend is not None and not backend.cacheable:
+        use_cache = False
+    travel_cache = cache.get_travel_time_cache() if use_cache else None
+    if batched:
+        error = _find_transfer_destinations(data, prim_to_update, comp_data,
+                                            nearby, travel_cache, backend,
+                                            workers)
+        _save_master_list(data, savedir=savedir)
+        if travel_cache is not None:
+            print(travel_cache)
+        if error is not None:
+            raise error
+        return
+
+    client = maps.get_client() if backend is None else None
+    for i, include in zip(tqdm(prim_to_update.index), nearby):
         prim_loc = geo.extract_locations(prim_to_update.loc[[i]])
         comp_locs = geo.extract_locations(comp_data.loc[include.index])
 
-        results = maps.get_transfer_destination(prim_loc, comp_locs, client)
+        results = maps.get_transfer_destination(prim_loc, comp_locs, client,
+                                                cache=travel_cache,
+                                                candidate_ids=include.index,
+                                                backend=backend)
 
         if not results:
             name = prim_to_update.Name[i]
@@ -200,8 +410,8 @@ def update_transfer_destinations(data=None):
         else:
             time = results['transfer_time']
             if pd.isnull(time):
-                hospital_id = np.NaN
-                hospital_name = np.NaN
+                hospital_id = np.nan
+                hospital_name = np.nan
             else:
                 hospital_index = results['destination_index']
                 hospital_id = include.index[hospital_index]
@@ -213,3 +423,103 @@ def update_transfer_destinations(data=None):
 
         # save after each iteration to minimize data loss on crash/cancel
         _save_master_list(data, savedir=savedir)
+
+    if travel_cache is not None:
+        print(travel_cache)
+
+
+def _find_transfer_destinations(data, primaries, comp_data, nearby,
+                                travel_cache=None, backend=None, workers=1):
+    '''
+    Find transfer destinations for many primaries at once. The nearby
+        comprehensive centers of every primary are packed into multi-origin
+        requests, then the fastest destination for each primary is picked in
+        a single pass over the full matrix of travel times. Primaries missing
+        any travel time because a request failed are left unchanged. Returns
+        the first error raised by a request, if any.
+    '''
+    if backend is None:
+        backend = routing.GoogleMapsBackend(with_traffic=False)
+    prim_locs = np.array(geo.extract_locations(primaries), dtype=float)
+    comp_locs = np.array(geo.extract_locations(comp_data), dtype=float)
+    comp_ids = comp_data.index
+
+    # requests and the travel time matrix use positions, not hospital IDs
+    needed = {
+        r: list(comp_ids.get_indexer(include.index))
+        for r, include in enumerate(nearby)
+    }
+    times = np.full((len(primaries), len(comp_data)), np.nan)
+    done = np.ones(times.shape, dtype=bool)
+    for r, cols in needed.items():
+        done[r, cols] = False
+
+    def pair_locations(pairs):
+        return [(tuple(prim_locs[r]), tuple(comp_locs[c])) for r, c in pairs]
+
+    if travel_cache is not None:
+        pairs = [(r, c) for r, cols in needed.items() for c in cols]
+        found = travel_cache.get(pair_locations(pairs), backend.mode)
+        _record_transfer_times(times, done, [pairs[k] for k in found],
+                               list(found.values()))
+        needed = {r: [c for c in cols if not done[r, c]]
+                  for r, cols in needed.items()}
+        needed = {r: cols for r, cols in needed.items() if cols}
+
+    requests = backend.plan(needed)
+    n_elements = sum(len(cols) for cols in needed.values())
+    print(f'Requesting {n_elements} travel times for {len(needed)} primaries' +
+          f' in {len(requests)} requests')
+
+    error = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(backend.elements,
+                        [tuple(prim_locs[r]) for r in rows],
+                        [tuple(comp_locs[c]) for c in cols]): (rows, cols)
+            for rows, cols in requests
+        }
+        for future in tqdm(as_completed(futures), total=len(futures),
+                           desc='Getting transfer times'):
+            rows, cols = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # keep the requests that finished and stop the rest
+                if error is None:
+                    error = e
+                    pool.shutdown(wait=False, cancel_futures=True)
+                continue
+            pairs = [(r, c) for r in rows for c in cols]
+            elements = [el for row in result for el in row]
+            if travel_cache is not None:
+                travel_cache.put(pair_locations(pairs), elements, backend.mode,
+                                 dest_ids=[comp_ids[c] for _, c in pairs])
+            _record_transfer_times(times, done, pairs, elements)
+
+    # fastest destination for each primary with all of its travel times
+    complete = done.all(axis=1)
+    filled = np.where(np.isnan(times), np.inf, times)
+    best = filled.argmin(axis=1)
+    fastest = filled[np.arange(len(best)), best]
+    reachable = np.isfinite(fastest)
+    # object arrays, so integer IDs aren't turned into floats by the NaNs
+    ids = pd.Series(comp_ids[best], dtype=object).where(reachable).to_numpy()
+    names = pd.Series(comp_data.Name.to_numpy()[best],
+                      dtype=object).where(reachable).to_numpy()
+
+    update = primaries.index[complete]
+    data.loc[update, 'transfer_time'] = np.where(reachable, fastest,
+                                                 np.nan)[complete]
+    data.loc[update, 'destinationID'] = ids[complete]
+    data.loc[update, 'destination'] = names[complete]
+    return error
+
+
+def _record_transfer_times(times, done, pairs, elements):
+    '''Store durations for (primary, comprehensive) position pairs'''
+    if not pairs:
+        return
+    rows, cols = np.array(pairs).T
+    times[rows, cols] = [element[0] for element in elements]
+    done[rows, cols] = True
@@ -0,0 +1,48 @@
+'''Append-only JSON lines journals for checkpointing long runs'''
+import os
+import json
+import numpy as np
+
+
+def _to_json(value):
+    '''Convert numpy scalars that json can't handle directly'''
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value)} is not JSON serializable')
+
+
+def append(path, records):
+    '''
+    Append a list of records (dicts) to the journal at path, making sure they
+        are on disk before returning
+    '''
+    if not records:
+        return
+    with open(path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record, default=_to_json) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read(path):
+    '''
+    Get the records in the journal at path, in the order they were written.
+        A partially written final record (from a crash) is ignored.
+    '''
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return records
+
+
+def remove(path):
+    '''Delete the journal at path once its records are stored elsewhere'''
+    if os.path.exists(path):
+        os.remove(path)
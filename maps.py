@@ -1,10 +1,19 @@
 '''Interact with google maps api'''
 import os
 import configparser
+import threading
+from collections import Counter
 import googlemaps
 import numpy as np
 import pandas as pd
 
+# Limits on a single Distance Matrix request
+MAX_ORIGINS = 25
+MAX_DESTINATIONS = 25
+MAX_ELEMENTS = 100
+# Number of upcoming origins considered when packing each request
+PLAN_WINDOW = 4 * MAX_ORIGINS
+
 
 class MapError(Exception):
     pass
@@ -40,11 +49,33 @@ def get_client():
     return googlemaps.Client(get_key())
 
 
-def get_hospital_location(searchterm, client=None):
+_thread_clients = threading.local()
+
+
+def get_thread_client():
+    '''
+    Get a googlemaps client for the current thread, creating it on first use,
+        since clients shouldn't be shared between threads
+    '''
+    if not hasattr(_thread_clients, 'client'):
+        _thread_clients.client = get_client()
+    return _thread_clients.client
+
+
+def get_hospital_location(searchterm, client=None, cache=None,
+                          refresh=False):
     '''
     Use the Google Places API to get the address and coordinates for a hospital
-        given a search term.
+        given a search term. If a `cache.GeocodeCache` is given, a stored
+        result for the same search term is used instead of a request, and new
+        results are stored in it. With refresh=True the search term is looked
+        up again even if it's in the cache.
     '''
+    if cache is not None and not refresh:
+        out = cached_hospital_location(searchterm, cache)
+        if out is not None:
+            return out
+
     if client is None:
         client = get_client()
 
@@ -52,12 +83,14 @@ def get_hospital_location(searchterm, client=None):
     results = googlemaps.places.find_place(client, searchterm, 'textquery',
                                            fields=basic)
 
-    if results['status'] != 'OK':
+    # other statuses are errors worth retrying, so aren't cached
+    if results['status'] not in ('OK', 'ZERO_RESULTS'):
         return {}
 
+    candidates = results.get('candidates', [])
     top_candidates = []
     other_candidates = []
-    for candidate in results['candidates']:
+    for candidate in candidates:
         if 'hospital' in candidate['types']:
             top_candidates.append(candidate)
         else:
@@ -68,6 +101,27 @@ def get_hospital_location(searchterm, client=None):
     elif len(other_candidates) > 0:
         hospital = other_candidates[0]
     else:
+        hospital = None
+
+    if cache is not None:
+        cache.put(searchterm, candidates, hospital, 'google')
+    return _place_location(hospital)
+
+
+def cached_hospital_location(searchterm, cache):
+    '''
+    Get the stored Places result for a search term from a
+        `cache.GeocodeCache`, or None if it hasn't been looked up recently
+    '''
+    stored = cache.get(searchterm, 'google')
+    if stored is None:
+        return None
+    return _place_location(stored[1])
+
+
+def _place_location(hospital):
+    '''Name, address and coordinates of a Places candidate'''
+    if hospital is None:
         return {}
 
     out = {}
@@ -79,38 +133,53 @@ def get_hospital_location(searchterm, client=None):
     return out
 
 
-def get_transfer_destination(location, candidates, client=None):
+def get_transfer_destination(location, candidates, client=None, cache=None,
+                             candidate_ids=None, backend=None):
     '''
     Given the location of a primary center and a dataframe of distances to
         comprehensive centers, return the index the optimal destination and the
         time it will take to get there.
         Location and candidates should both be lists of (lat, lng) tuples
-        Uses the distance matrix API without traffic information
+        Uses the distance matrix API without traffic information, or the
+        given `routing` backend, only requesting times not found in the given
+        TravelTimeCache
     '''
-    if client is None:
-        client = get_client()
-
-    matrix = client.distance_matrix(
-        origins=location,
-        destinations=candidates,
-        mode='driving'
-    )
+    mode = 'driving' if backend is None else backend.mode
+    pairs = [(location[0], candidate) for candidate in candidates]
+    found = {} if cache is None else cache.get(pairs, mode)
+    missing = [j for j in range(len(candidates)) if j not in found]
+    elements = dict(found)
 
     out = {}
-    if matrix['status'] != 'OK' or len(matrix['rows']) != 1:
-        return out
-
-    elements = matrix['rows'][0]['elements']
-    times = []
-    for el in elements:
-        if el['status'] == 'OK':
-            times.append(el['duration']['value'] / 60)
-        else:
-            times.append(np.NaN)
+    if missing and backend is not None:
+        new = backend.elements(location, [candidates[j] for j in missing])[0]
+    elif missing:
+        if client is None:
+            client = get_client()
+
+        matrix = client.distance_matrix(
+            origins=location,
+            destinations=[candidates[j] for j in missing],
+            mode='driving'
+        )
+
+        if matrix['status'] != 'OK' or len(matrix['rows']) != 1:
+            return out
+
+        new = [parse_element(el) for el in matrix['rows'][0]['elements']]
+
+    if missing:
+        if cache is not None:
+            ids = (None if candidate_ids is None else
+                   [candidate_ids[j] for j in missing])
+            cache.put([pairs[j] for j in missing], new, mode, dest_ids=ids)
+        elements.update(zip(missing, new))
+
+    times = [elements[j][0] for j in range(len(candidates))]
 
     time = min(times)
     if pd.isnull(time):
-        hospital_index = np.NaN
+        hospital_index = np.nan
     else:
         hospital_index = times.index(time)
 
@@ -118,3 +187,97 @@ def get_transfer_destination(location, candidates, client=None):
     out['destination_index'] = hospital_index
 
     return out
+
+
+def parse_element(element):
+    '''
+    Get the travel time and travel time in traffic in minutes, along with the
+        status, from a single Distance Matrix element. Times are NaN if
+        unavailable.
+    '''
+    status = element['status']
+    if status != 'OK':
+        return np.nan, np.nan, status
+    duration = element['duration']['value'] / 60
+    if 'duration_in_traffic' in element:
+        traffic = element['duration_in_traffic']['value'] / 60
+    else:
+        traffic = np.nan
+    return duration, traffic, status
+
+
+def get_travel_time_elements(origins, destinations, client=None,
+                             departure_time=None, traffic_model='pessimistic'):
+    '''
+    Make one Distance Matrix request and return its parsed elements as a list
+        with one row per origin and one (duration, traffic, status) tuple per
+        destination. Traffic is only requested if departure_time is given.
+        Origins and destinations should both be lists of (lat, lng) tuples
+    '''
+    if client is None:
+        client = get_client()
+
+    if departure_time is None:
+        matrix = client.distance_matrix(origins=origins,
+                                        destinations=destinations,
+                                        mode='driving')
+    else:
+        matrix = client.distance_matrix(origins=origins,
+                                        destinations=destinations,
+                                        mode='driving',
+                                        departure_time=departure_time,
+                                        traffic_model=traffic_model)
+
+    if matrix['status'] != 'OK' or len(matrix['rows']) != len(origins):
+        raise MapError(f"Distance Matrix request failed: {matrix['status']}")
+
+    return [[parse_element(el) for el in row['elements']]
+            for row in matrix['rows']]
+
+
+def _request_size(n_origins, n_destinations):
+    '''Elements in the largest request with these origins/destinations'''
+    n_origins = min(n_origins, MAX_ORIGINS, MAX_ELEMENTS // n_destinations)
+    return n_origins * n_destinations
+
+
+def plan_requests(needed):
+    '''
+    Pack origin/destination pairs into as few multi-origin Distance Matrix
+        requests as possible. `needed` maps each origin to a list of the
+        destinations it needs, closest first. Returns a list of
+        (origins, destinations) pairs, where every needed pair appears in
+        exactly one request and no request contains a pair that isn't needed.
+    '''
+    remaining = {o: set(dests) for o, dests in needed.items()}
+    # Origins with similar closest destinations end up next to each other,
+    #   so each request only has to look at a small window of origins
+    order = sorted(remaining, key=lambda o: [str(d) for d in needed[o]])
+
+    requests = []
+    for i, seed in enumerate(order):
+        while remaining[seed]:
+            window = [o for o in order[i:i + PLAN_WINDOW] if remaining[o]]
+            dests = []
+            origins = window
+            size = 0
+            while len(dests) < MAX_DESTINATIONS:
+                counts = Counter(d for o in origins for d in needed[o]
+                                 if d in remaining[o] and
+                                 d in remaining[seed] and d not in dests)
+                if not counts:
+                    break
+                best, count = max(counts.items(), key=lambda x: x[1])
+                new_size = _request_size(count, len(dests) + 1)
+                if new_size <= size:
+                    break
+                dests.append(best)
+                origins = [o for o in origins if best in remaining[o]]
+                size = new_size
+
+            origins = origins[:size // len(dests)]
+            for o in origins:
+                remaining[o].difference_update(dests)
+            requests.append((origins, dests))
+
+    return requests
@@ -3,14 +3,19 @@ import os
 import argparse
 import pandas as pd
 import numpy as np
-import shapely.geometry as sh_geo
+import shapely
+import pyarrow as pa
+import pyarrow.parquet as pq
 import census
-import tools
+import atlas
 
 POINTS_DIR = os.path.join('data', 'points')
 if not os.path.isdir(POINTS_DIR):
     os.makedirs(POINTS_DIR)
 
+# Number of points drawn at a time when streaming points to a file
+CHUNK_SIZE = 100000
+
 NORTHEAST = [
     'Maine',
     'Vermont',
@@ -22,75 +27,269 @@ NORTHEAST = [
 ]
 
 
-def generate_points(states=['Connecticut'], n=1000, name=None):
+def generate_points(states=['Connecticut'],
+                    n=1000,
+                    name=None,
+                    seed=None,
+                    sampler='triangles',
+                    use_atlas=True,
+                    workers=1,
+                    weights='POP10',
+                    stratify=None,
+                    sobol=False):
     '''
     Generate a set of points randomly distributed across the given states
         according to population density. Points are returned as a dataframe
-        and saved to a csv, using the given name or the names of the states
-    '''
-    data, states = census.read_states(states)
-    grid = _get_points(data, n)
+        and saved to a csv, using the given name or the names of the states.
+        weights can be POP10 or any weight registered in census.WEIGHTS,
+        such as over_75. stratify ('county' or 'tract') allocates points to
+        strata in proportion to weight, optionally placing them with a
+        scrambled Sobol sequence (sobol=True); this uses the atlas.
+    '''
+    print(f"Generating {n} points")
+    if use_atlas or stratify:
+        grid, states = _get_atlas_points(states,
+                                         n,
+                                         weights=weights,
+                                         seed=seed,
+                                         workers=workers,
+                                         stratify=stratify,
+                                         sobol=sobol)
+    else:
+        grid, states = _get_points_by_county(states,
+                                             n,
+                                             weights=weights,
+                                             seed=seed,
+                                             sampler=sampler,
+                                             workers=workers)
 
     if name is None:
         name = '_'.join(states)
 
     #Create LOC_ID
-    grid = grid.reset_index(drop=True)
-    grid['LOC_ID'] = grid.index
-    grid['LOC_ID'] = grid.LOC_ID.apply(
-        lambda x: 'L' + tools.cast_to_int_then_str(x))
-    grid.set_index('LOC_ID', inplace=True)
+    grid.index = _loc_ids(0, len(grid))
     grid.to_csv(os.path.join(POINTS_DIR, f'{name}_n={n}.csv'))
     return grid
 
 
 def load_points(points_path):
+    if str(points_path).endswith('.parquet'):
+        return pd.read_parquet(points_path)
     points = pd.read_csv(points_path)
     if 'LOC_ID' in points.columns: points.set_index('LOC_ID', inplace=True)
     return points
 
 
-def generate_points_age_adjusted(states=['New York'], n=1000, name=None):
-    '''
-    Generate a set of points randomly distributed across the given states
-        according to population density. Points are returned as a dataframe
-        and saved to a csv, using the given name or the names of the states
+def generate_points_age_adjusted(states=['New York'],
+                                 n=1000,
+                                 name=None,
+                                 weights='over_65',
+                                 **kwargs):
+    '''
+    Generate points like generate_points, weighted by the population 65
+        and older (or another registered weight) by default
     '''
-    data, states = census.read_states_age_adjusted(states)
-    print(f"Generating {n} points")
-    grid = _get_points(data=data, n=n, weights='over_65')
+    return generate_points(states, n, name, weights=weights, **kwargs)
+
 
+def stream_points(states=['New York'],
+                  n=1000,
+                  name=None,
+                  weights='over_65',
+                  seed=None,
+                  chunk_size=CHUNK_SIZE,
+                  file_format='csv',
+                  workers=1):
+    '''
+    Generate points from the sampling atlases like generate_points, but draw
+        them chunk_size at a time and append each chunk to a csv or parquet
+        file, so memory use stays flat however large n is. Returns the path
+        to the file.
+    '''
+    states, chunks = atlas.stream_states(states,
+                                         n,
+                                         weights,
+                                         seed=seed,
+                                         chunk_size=chunk_size,
+                                         workers=workers)
     if name is None:
         name = '_'.join(states)
+    path = os.path.join(POINTS_DIR, f'{name}_n={n}.{file_format}')
 
-    #Create LOC_ID
-    grid = grid.reset_index(drop=True)
-    grid['LOC_ID'] = grid.index
-    grid['LOC_ID'] = grid.LOC_ID.apply(
-        lambda x: 'L' + tools.cast_to_int_then_str(x))
-    grid.set_index('LOC_ID', inplace=True)
-    grid.to_csv(os.path.join(POINTS_DIR, f'{name}_n={n}.csv'))
-    return grid
+    writer = None
+    start = 0
+    try:
+        for coords, _ in chunks:
+            stop = start + len(coords)
+            grid = pd.DataFrame(
+                {
+                    'Latitude': coords[:, 1],
+                    'Longitude': coords[:, 0]
+                },
+                index=_loc_ids(start, stop))
+            if file_format == 'parquet':
+                table = pa.Table.from_pandas(grid)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+            else:
+                grid.to_csv(path, mode='a' if start else 'w', header=not start)
+            start = stop
+            print(f'Wrote {stop} of {n} points')
+    finally:
+        if writer is not None:
+            writer.close()
+    return path
 
 
-def _get_random_point_in_polygon(poly):
-    '''From https://gis.stackexchange.com/a/6413'''
-    (minx, miny, maxx, maxy) = poly.bounds
-    while True:
-        p = sh_geo.Point(np.random.uniform(minx, maxx),
-                         np.random.uniform(miny, maxy))
-        if poly.contains(p):
-            return p
+def _loc_ids(start, stop):
+    '''Location IDs L<start> through L<stop - 1>'''
+    ids = np.char.add('L', np.arange(start, stop).astype(str))
+    return pd.Index(ids, name='LOC_ID')
 
 
-def _get_points(data, n=1000, weights='POP10'):
-    samp = data.sample(n, replace=True, weights=weights)
-    points = samp.geometry.apply(_get_random_point_in_polygon)
-    out = pd.DataFrame({
-        'Latitude': points.apply(lambda p: p.y),
-        'Longitude': points.apply(lambda p: p.x)
-    })
-    return out
+def _sample_rejection(polys, which, rng):
+    '''
+    Draw a point uniformly from inside polys[i] for each i in which by
+        drawing candidates in each polygon's bounding box and redrawing only
+        those that fall outside. Returns an array of (x, y) coordinates.
+    '''
+    polys = np.asarray(polys)
+    shapely.prepare(polys)
+    bounds = shapely.bounds(polys)[which]
+    coords = np.empty((len(which), 2))
+    pending = np.arange(len(which))
+    while len(pending):
+        low, high = bounds[pending, :2], bounds[pending, 2:]
+        candidates = low + rng.random((len(pending), 2)) * (high - low)
+        inside = shapely.contains_xy(polys[which[pending]], candidates[:, 0],
+                                     candidates[:, 1])
+        coords[pending[inside]] = candidates[inside]
+        pending = pending[~inside]
+    return coords
+
+
+def _sample_triangles(polys, which, rng):
+    '''
+    Draw a point uniformly from inside polys[i] for each i in which. Each
+        polygon is triangulated once, then a triangle is chosen with
+        probability proportional to its area and barycentric coordinates are
+        drawn inside it. Returns an array of (x, y) coordinates.
+    '''
+    vertices, owner, areas = atlas.triangulate(polys)
+    cum_areas, starts, ends = atlas.triangle_offsets(owner, areas, len(polys))
+    return atlas.draw_in_triangles(vertices, cum_areas, starts, ends, which,
+                                   rng)
+
+
+SAMPLERS = {
+    'triangles': _sample_triangles,
+    'rejection': _sample_rejection,
+}
+
+
+def _get_points_by_county(states,
+                          n=1000,
+                          weights='POP10',
+                          seed=None,
+                          sampler='triangles',
+                          workers=1):
+    '''
+    Draw n points across the given states in two stages: split n across
+        counties by their total weight, then read block geometry only for
+        the counties drawn and sample blocks and points within them.
+        Returns the points and a list of abbreviations for all states used.
+    '''
+    rng = np.random.default_rng(seed)
+    blocks, states = census.read_block_weights(states, weights, workers)
+    counties = blocks.groupby(['state', 'county'])[weights].sum()
+    counts = pd.Series(rng.multinomial(n, counties / counties.sum()),
+                       index=counties.index)
+    counts = counts[counts > 0]
+
+    parts = []
+    for state, state_counts in counts.groupby(level='state'):
+        drawn = state_counts.index.get_level_values('county')
+        geometry = census.read_county_blocks(state, drawn, weights)
+        rows = []
+        for county, k in state_counts.droplevel('state').items():
+            candidates = blocks[(blocks.state == state) &
+                                (blocks.county == county)]
+            p = candidates[weights].to_numpy(dtype=float)
+            rows.append(
+                rng.choice(candidates.index.to_numpy(), size=k,
+                           p=p / p.sum()))
+        rows = np.concatenate(rows)
+        geoids, which = np.unique(rows, return_inverse=True)
+        parts.append(SAMPLERS[sampler](geometry.loc[geoids].values, which,
+                                       rng))
+    coords = np.concatenate(parts)[rng.permutation(n)]
+    out = pd.DataFrame({'Latitude': coords[:, 1], 'Longitude': coords[:, 0]})
+    return out, states
+
+
+def _get_atlas_points(states,
+                      n=1000,
+                      weights='POP10',
+                      seed=None,
+                      workers=1,
+                      stratify=None,
+                      sobol=False):
+    '''
+    Draw n points across the given states from their precomputed sampling
+        atlases, either independently or stratified by county or tract.
+        Returns the points and a list of abbreviations for all states used.
+    '''
+    if stratify is None:
+        coords, _, states = atlas.sample_states(states,
+                                                n,
+                                                weights,
+                                                seed=seed,
+                                                workers=workers)
+    else:
+        coords, _, strata, represents, states = atlas.stratified_states(
+            states,
+            n,
+            weights,
+            seed=seed,
+            level=stratify,
+            sobol=sobol,
+            workers=workers)
+        ess = min(
+            _stratified_ess(coords[:, i], strata, represents)
+            for i in range(2))
+        print(f'Stratified {n} points across {len(np.unique(strata))} ' +
+              f'{stratify} strata. Effective sample size: ' +
+              f'{effective_sample_size(represents):.0f} from weights, ' +
+              f'{ess:.0f} for the mean location')
+    out = pd.DataFrame({'Latitude': coords[:, 1], 'Longitude': coords[:, 0]})
+    return out, states
+
+
+def effective_sample_size(weights):
+    '''Kish's effective sample size for points with unequal weights'''
+    weights = np.asarray(weights, dtype=float)
+    return weights.sum()**2 / (weights**2).sum()
+
+
+def _stratified_ess(values, strata, represents):
+    '''
+    Number of independent points whose sample mean would have the same
+        variance as the stratified estimate of the mean of values. Within
+        stratum variances are estimated as if points were independent, so
+        this is conservative for Sobol placement.
+    '''
+    frame = pd.DataFrame({'y': values, 'h': strata, 'w': represents})
+    groups = frame.groupby('h')
+    n_h = groups.size()
+    share = groups.w.sum() / frame.w.sum()
+    within = groups.y.var()
+    # strata with a single point get the average within stratum variance
+    within = within.fillna(within.mean()).fillna(0)
+    stratified = (share**2 * within / n_h).sum()
+    mean = np.average(values, weights=represents)
+    total = np.average((values - mean)**2, weights=represents)
+    return total / stratified if stratified > 0 else np.inf
 
 
 def main(args):
@@ -103,7 +302,26 @@ def main(args):
     n = args.points
     name = args.filename
 
-    generate_points_age_adjusted(states, n, name)
+    if args.chunk_size:
+        stream_points(states,
+                      n,
+                      name,
+                      weights=args.weights,
+                      seed=args.seed,
+                      chunk_size=args.chunk_size,
+                      file_format='parquet' if args.parquet else 'csv',
+                      workers=args.workers)
+        return
+    generate_points_age_adjusted(states,
+                                 n,
+                                 name,
+                                 seed=args.seed,
+                                 sampler=args.sampler,
+                                 use_atlas=not args.no_atlas,
+                                 workers=args.workers,
+                                 weights=args.weights,
+                                 stratify=args.stratify,
+                                 sobol=args.sobol)
 
 
 if __name__ == '__main__':
@@ -124,5 +342,43 @@ if __name__ == '__main__':
                         '-f',
                         default=name_default,
                         help=name_help)
+    weights_help = 'Population to weight points by (default over_65)'
+    parser.add_argument('--weights',
+                        choices=list(census.WEIGHTS),
+                        default='over_65',
+                        help=weights_help)
+    seed_help = 'Random seed, for reproducible points'
+    parser.add_argument('--seed', '-s', type=int, default=None, help=seed_help)
+    workers_help = 'Number of processes for reading census files (default 1)'
+    parser.add_argument('--workers',
+                        '-w',
+                        type=int,
+                        default=1,
+                        help=workers_help)
+    chunk_help = 'Stream points to the file in chunks of this many points'
+    parser.add_argument('--chunk_size', type=int, default=None, help=chunk_help)
+    parquet_help = 'Write streamed points to a parquet file instead of a csv'
+    parser.add_argument('--parquet', action='store_true', help=parquet_help)
+    stratify_help = 'Allocate points to counties or tracts by weight'
+    parser.add_argument('--stratify',
+                        choices=list(atlas.STRATA),
+                        default=None,
+                        help=stratify_help)
+    sobol_help = 'Place stratified points with a scrambled Sobol sequence'
+    parser.add_argument('--sobol', action='store_true', help=sobol_help)
+    atlas_help = 'Read census shapefiles instead of the saved sampling atlas'
+    parser.add_argument('--no_atlas', action='store_true', help=atlas_help)
+    sampler_help = 'How to draw points inside census blocks with --no_atlas'
+    parser.add_argument('--sampler',
+                        choices=list(SAMPLERS),
+                        default='triangles',
+                        help=sampler_help)
     args = parser.parse_args()
+    # streamed points are drawn independently from the atlas
+    if args.chunk_size and (args.stratify or args.sobol or args.no_atlas or
+                            args.sampler != 'triangles'):
+        parser.error('--chunk_size cannot be used with --stratify, --sobol, ' +
+                     '--no_atlas or --sampler')
+    if args.parquet and not args.chunk_size:
+        parser.error('--parquet requires --chunk_size')
     main(args)
@@ -0,0 +1,139 @@
+'''
+Backends for computing driving times between locations. Each backend plans
+    how to split the needed (origin, destination) pairs into requests and
+    returns (duration, traffic, status) elements for each request, with
+    durations in minutes.
+'''
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from sklearn.neighbors import BallTree
+import maps
+import geo_utilities as geo
+
+# Speeds (mph) by OSM highway type for roads without a maxspeed tag
+DEFAULT_SPEEDS = {
+    'motorway': 65,
+    'motorway_link': 45,
+    'trunk': 55,
+    'trunk_link': 40,
+    'primary': 45,
+    'primary_link': 35,
+    'secondary': 40,
+    'secondary_link': 30,
+    'tertiary': 35,
+    'tertiary_link': 25,
+    'unclassified': 30,
+    'residential': 25,
+    'living_street': 15,
+    'service': 15,
+}
+FALLBACK_SPEED = 25
+# Speed (mph) for the straight line from a location to its nearest road
+ACCESS_SPEED = 15
+KM_PER_MILE = 1.609344
+
+
+class GoogleMapsBackend:
+    '''
+    Travel times from the Google Maps Distance Matrix API, with requests
+        packed to respect its limits
+    '''
+    cacheable = True
+
+    def __init__(self, with_traffic=True, traffic_model='pessimistic'):
+        self.with_traffic = with_traffic
+        self.traffic_model = traffic_model
+        self.mode = f'driving-{traffic_model}' if with_traffic else 'driving'
+
+    def plan(self, needed):
+        '''Split needed destinations for each origin into requests'''
+        return maps.plan_requests(needed)
+
+    def elements(self, origins, destinations, departure_time=None):
+        '''Travel time elements for every origin/destination pair'''
+        if not self.with_traffic:
+            departure_time = None
+        return maps.get_travel_time_elements(origins, destinations,
+                                             maps.get_thread_client(),
+                                             departure_time=departure_time,
+                                             traffic_model=self.traffic_model)
+
+
+def _edge_speeds(edges):
+    '''Speed in mph for each edge, from maxspeed tags or the road type'''
+    tagged = edges.maxspeed.astype(str).str.extract(r'(\d+\.?\d*)\s*(mph)?')
+    speed = pd.to_numeric(tagged[0], errors='coerce')
+    # OSM speeds are km/h unless marked as mph
+    speed = speed.where(tagged[1].notna(), speed / KM_PER_MILE)
+    default = edges.highway.map(DEFAULT_SPEEDS).fillna(FALLBACK_SPEED)
+    return speed.fillna(default).clip(lower=5).to_numpy()
+
+
+class LocalRoadBackend:
+    '''
+    Driving times without traffic over the road network in a local
+        OpenStreetMap extract (.osm.pbf). Each request is a single Dijkstra
+        search outward from one hospital over the reversed road graph, which
+        gives the time to that hospital from every point at once.
+    '''
+    cacheable = False
+    with_traffic = False
+    mode = 'osm-driving'
+
+    def __init__(self, osm_file, max_minutes=None):
+        import pyrosm
+
+        nodes, edges = pyrosm.OSM(osm_file).get_network(
+            network_type='driving', nodes=True)
+        position = pd.Series(np.arange(len(nodes)), index=nodes.id.values)
+        u = position[edges.u.values].to_numpy()
+        v = position[edges.v.values].to_numpy()
+        minutes = (edges.length.to_numpy() / geo.METERS_PER_MILE /
+                   _edge_speeds(edges) * 60)
+
+        oneway = edges.oneway.fillna('no').astype(str).str.lower()
+        forward = (oneway != '-1').to_numpy()
+        backward = ~oneway.isin(['yes', 'true', '1']).to_numpy()
+        links = pd.DataFrame({
+            'from': np.concatenate([u[forward], v[backward]]),
+            'to': np.concatenate([v[forward], u[backward]]),
+            'minutes': np.concatenate([minutes[forward], minutes[backward]]),
+        }).groupby(['from', 'to']).minutes.min().reset_index()
+        # reversed so searches from a hospital give times *to* the hospital
+        self.reverse = csr_matrix(
+            (links.minutes, (links.to, links['from'])),
+            shape=(len(nodes), len(nodes)))
+
+        self.max_minutes = np.inf if max_minutes is None else max_minutes
+        self.tree = BallTree(np.radians(nodes[['lat', 'lon']].to_numpy()),
+                             metric='haversine')
+
+    def _snap(self, locs):
+        '''Nearest road node and minutes to reach it for each location'''
+        dist, ind = self.tree.query(np.radians(np.asarray(locs, dtype=float)),
+                                    k=1)
+        access = dist[:, 0] * geo.EARTH_RADIUS_MILES / ACCESS_SPEED * 60
+        return ind[:, 0], access
+
+    def plan(self, needed):
+        '''One request per destination, covering every origin that needs it'''
+        by_destination = {}
+        for origin, destinations in needed.items():
+            for destination in destinations:
+                by_destination.setdefault(destination, []).append(origin)
+        return [(origins, [destination])
+                for destination, origins in by_destination.items()]
+
+    def elements(self, origins, destinations, departure_time=None):
+        '''Travel time elements for every origin/destination pair'''
+        origin_nodes, origin_access = self._snap(origins)
+        dest_nodes, dest_access = self._snap(destinations)
+        times = dijkstra(self.reverse, indices=dest_nodes,
+                         limit=self.max_minutes)
+        times = (times[:, origin_nodes].T + origin_access[:, None] +
+                 dest_access[None, :])
+        return [[(t, np.nan, 'OK') if np.isfinite(t) else
+                 (np.nan, np.nan, 'ZERO_RESULTS') for t in row]
+                for row in times]
@@ -0,0 +1,19 @@
+'''Registered age band weights'''
+import pytest
+import census
+
+
+@pytest.mark.parametrize('youngest, oldest', [(63, None), (70, 80), (0, 3),
+                                              (65, 64)])
+def test_register_weight_off_band(youngest, oldest):
+    with pytest.raises(ValueError):
+        census.register_weight('off_band', youngest, oldest)
+    assert 'off_band' not in census.WEIGHTS
+
+
+def test_weight_columns():
+    census.register_weight('ages_70_84', 70, 84, sexes=['female'])
+    try:
+        assert census.weight_columns('ages_70_84') == ['D046', 'D047', 'D048']
+    finally:
+        del census.WEIGHTS['ages_70_84']
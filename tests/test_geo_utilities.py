@@ -0,0 +1,67 @@
+'''Vectorized distance kernels checked against geopy'''
+import numpy as np
+import pytest
+from geopy.distance import distance as geopy_distance
+import geo_utilities as geo
+
+# Rough bounding box of the contiguous United States
+CONUS_LAT = (24.5, 49.5)
+CONUS_LNG = (-125.0, -66.9)
+
+
+@pytest.fixture(scope='module')
+def pairs():
+    rng = np.random.default_rng(0)
+    n = 500
+    lat = rng.uniform(*CONUS_LAT, size=(n, 2))
+    lng = rng.uniform(*CONUS_LNG, size=(n, 2))
+    rows = np.column_stack([lat[:, 0], lng[:, 0]])
+    cols = np.column_stack([lat[:, 1], lng[:, 1]])
+    # include some short distances, as between points and nearby hospitals
+    cols[:50] = rows[:50] + rng.normal(scale=0.05, size=(50, 2))
+    expected = np.array([
+        geopy_distance(tuple(r), tuple(c)).miles for r, c in zip(rows, cols)
+    ])
+    return rows, cols, expected
+
+
+def _pairwise(rows, cols, method):
+    return np.array([
+        geo.distances([r], [c], method=method)[0, 0]
+        for r, c in zip(rows, cols)
+    ])
+
+
+def test_vincenty_matches_geopy(pairs):
+    rows, cols, expected = pairs
+    np.testing.assert_allclose(_pairwise(rows, cols, 'vincenty'),
+                               expected,
+                               rtol=0,
+                               atol=1e-6)
+
+
+def test_haversine_within_half_percent_of_geopy(pairs):
+    rows, cols, expected = pairs
+    np.testing.assert_allclose(_pairwise(rows, cols, 'haversine'),
+                               expected,
+                               rtol=0.005)
+
+
+def test_distance_matrix_shape_and_cutoff(pairs):
+    rows, cols, _ = pairs
+    rows, cols = rows[:20], cols[:30]
+    matrix = geo.distances(rows, cols)
+    assert matrix.shape == (20, 30)
+    expected = np.array([[geopy_distance(tuple(r), tuple(c)).miles
+                          for c in cols] for r in rows])
+    np.testing.assert_allclose(matrix, expected, rtol=0, atol=1e-6)
+
+    table = geo.distance_matrix(rows, cols, range(20), range(30))
+    np.testing.assert_allclose(table.Cutoff,
+                               geo.cutoff(expected.min(axis=1)),
+                               rtol=1e-9)
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        geo.distances([(40, -75)], [(41, -75)], method='manhattan')
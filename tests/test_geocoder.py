@@ -0,0 +1,36 @@
+'''Offline matching of hospitals against a reference table'''
+import pandas as pd
+import pytest
+import geocoder
+
+
+@pytest.mark.parametrize('place, expected', [
+    ('New Haven CT 06510', '06510'),
+    ('New Haven CT 06510-3202', '06510'),
+    ('Hartford CT 061025037', '06102'),
+    ('1450 Main St Springfield MA', None),
+    ('20 York St New Haven CT 06510', '06510'),
+    ('', None),
+])
+def test_zip_code(place, expected):
+    assert geocoder._zip_code(place) == expected
+
+
+def test_match_zip_plus_four():
+    reference = pd.DataFrame({
+        'Name': ['Yale New Haven Hospital', 'Hartford Hospital'],
+        'Address': [
+            '20 York St, New Haven, CT 06510',
+            '80 Seymour St, Hartford, CT 06102'
+        ],
+        'Latitude': [41.3036, 41.7548],
+        'Longitude': [-72.9361, -72.6791],
+    })
+    index = geocoder.ReferenceIndex(reference)
+    names = pd.Series(['Yale-New Haven Hospital', 'Hartford Hospital'],
+                      index=['A', 'B'])
+    places = pd.Series(['New Haven CT 06510-3202', 'Hartford CT 06102-5037'],
+                       index=['A', 'B'])
+    matches = index.match(names, places)
+    assert list(matches.index) == ['A', 'B']
+    assert list(matches.Name) == list(reference.Name)
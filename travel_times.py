@@ -1,12 +1,16 @@
 '''Get and store travel times from specified locations to hospitals'''
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
 import geo_utilities as geo
+import cache
+import journal
 import hospitals
 import maps
+import routing
 from pathlib import Path
 import population
 
@@ -15,20 +19,201 @@ if not os.path.isdir(TIMES_DIR):
     os.makedirs(TIMES_DIR)
 LARGE_LIMIT = 10
 
+# Element status codes stored in the long format travel times
+STATUS_CODES = {
+    'OK': 0,
+    'NOT_FOUND': 1,
+    'ZERO_RESULTS': 2,
+    'MAX_ROUTE_LENGTH_EXCEEDED': 3,
+}
+UNKNOWN_STATUS = -1
+
+
 def read_travel_times(time_file):
+    '''
+    Read travel times in the wide format used by the model, with a row per
+        point and a column per hospital. Uses the long format parquet store
+        for the file if there is one, with a row for every point in the csv.
+    '''
+    long_path = _long_path(time_file)
+    if os.path.exists(long_path):
+        wide = to_wide(read_long_travel_times(long_path))
+        if os.path.exists(time_file):
+            # points without any times only appear in the csv
+            loc_ids = pd.read_csv(time_file, usecols=['LOC_ID'], dtype=str)
+            wide = wide.reindex(pd.Index(loc_ids.LOC_ID, name='LOC_ID'))
+        return wide
     return pd.read_csv(time_file,low_memory=False,index_col='LOC_ID')
 
+
+def read_long_travel_times(long_file):
+    '''
+    Read travel times in long format, with one row per (LOC_ID, HOSP_ID)
+        pair and typed duration_min, traffic_min, and status columns
+    '''
+    return pd.read_parquet(long_file)
+
+
+def to_wide(long_times):
+    '''
+    Pivot long format travel times to the model's wide format, where times
+        with traffic are stored as "duration,duration_in_traffic"
+    '''
+    values = long_times.duration_min.astype(object)
+    has_traffic = long_times.traffic_min.notna()
+    values[has_traffic] = (
+        long_times.duration_min[has_traffic].astype(str) + ',' +
+        long_times.traffic_min[has_traffic].astype(str))
+    values[long_times.status != STATUS_CODES['OK']] = np.nan
+    wide = pd.Series(values.values,
+                     index=pd.MultiIndex.from_arrays(
+                         [long_times.LOC_ID, long_times.HOSP_ID])).unstack()
+    wide.index.name = 'LOC_ID'
+    wide.columns.name = None
+    return wide
+
+
+def _long_path(times_path):
+    '''Path to the long format parquet store for a travel times csv'''
+    return os.path.splitext(str(times_path))[0] + '.parquet'
+
+
+def _journal_results(journal_path):
+    '''Get the travel time elements in a journal in long format'''
+    rows = [(record['LOC_ID'], hosp_id, *element)
+            for record in journal.read(journal_path)
+            for hosp_id, element in record.get('times', {}).items()]
+    results = pd.DataFrame(rows,
+                           columns=[
+                               'LOC_ID', 'HOSP_ID', 'duration_min',
+                               'traffic_min', 'status'
+                           ])
+    return results.astype({
+        'LOC_ID': str,
+        'HOSP_ID': str,
+        'duration_min': np.float32,
+        'traffic_min': np.float32,
+    }).assign(status=results.status.map(STATUS_CODES).fillna(
+        UNKNOWN_STATUS).astype(np.int8))
+
+
+def _wide_results(all_times, loc_ids):
+    '''
+    Get the travel times stored for the given points in a wide times table
+        in long format, leaving out missing times
+    '''
+    hosp_ids = [
+        c for c in all_times.columns
+        if c not in ['Latitude', 'Longitude', 'Need_Update']
+    ]
+    values = all_times.loc[list(loc_ids), hosp_ids].stack().dropna()
+    parts = values.astype(str).str.split(',', expand=True)
+    duration = pd.to_numeric(parts[0], errors='coerce')
+    traffic = (pd.to_numeric(parts[1], errors='coerce')
+               if 1 in parts.columns else pd.Series(np.nan, parts.index))
+    results = pd.DataFrame({
+        'LOC_ID': values.index.get_level_values(0).astype(str),
+        'HOSP_ID': values.index.get_level_values(1).astype(str),
+        'duration_min': np.asarray(duration, dtype=np.float32),
+        'traffic_min': np.asarray(traffic, dtype=np.float32),
+        'status': np.int8(STATUS_CODES['OK']),
+    })
+    return results[results.duration_min.notna()]
+
+
+def _update_long_times(long_path, results):
+    '''
+    Merge new long format results into the parquet store. New times replace
+        stored ones, except that failed lookups don't replace stored times.
+    '''
+    if results.empty:
+        return
+    ok = results.status == STATUS_CODES['OK']
+    parts = [results[ok], results[~ok]]
+    if os.path.exists(long_path):
+        parts.insert(1, read_long_travel_times(long_path))
+    merged = pd.concat(parts, ignore_index=True).drop_duplicates(
+        ['LOC_ID', 'HOSP_ID'], keep='first')
+    merged.sort_values(['LOC_ID', 'HOSP_ID']).to_parquet(long_path,
+                                                         index=False)
+
+
 def _get_travel_times_csv(times_path, points, all_hospitals):
     times_path = Path(times_path)
     if times_path.exists():
         times = pd.read_csv(times_path)
         if 'LOC_ID' in times.columns: times.set_index('LOC_ID', inplace=True)
-        return times
     else:
         #make one
-        return points.assign(Need_Update=False).assign(
+        times = points.assign(Need_Update=False).assign(
             **{c: np.nan
                for c in all_hospitals.index})
+    # resume from any results not yet compacted into the csv
+    _replay_journal(times, _journal_path(times_path))
+    return times
+
+
+def _journal_path(times_path):
+    '''Path to the journal of results not yet written to times_path'''
+    return str(times_path) + '.journal'
+
+
+def _replay_journal(all_times, journal_path):
+    '''
+    Apply the records in a travel times journal to the times table. Points
+        listed as pending stay marked Need_Update until a record says they're
+        done, so partially computed points are picked up again.
+    '''
+    records = journal.read(journal_path)
+    if not records:
+        return
+    print(f'Resuming from {len(records)} records in {journal_path}')
+    columns = {str(c): c for c in all_times.columns}
+    times = {}
+    pending = set()
+    done = set()
+    for record in records:
+        if 'pending' in record:
+            pending.update(record['pending'])
+            done.difference_update(record['pending'])
+            continue
+        loc_id = record['LOC_ID']
+        times.setdefault(loc_id, {}).update({
+            columns[hosp_id]: _format_time(*element)
+            for hosp_id, element in record.get('times', {}).items()
+            if hosp_id in columns
+        })
+        if record.get('done'):
+            done.add(loc_id)
+            pending.discard(loc_id)
+
+    times = pd.DataFrame.from_dict(times, orient='index')
+    if not times.empty:
+        all_times[times.columns] = all_times[times.columns].astype(object)
+        all_times.update(times, overwrite=True)
+    all_times.loc[list(pending), 'Need_Update'] = True
+    all_times.loc[list(done), 'Need_Update'] = False
+
+
+def _compact(all_times, times_path):
+    '''
+    Write the full times table and the long format store once and discard
+        the journal. Points missing from the store, such as those computed
+        before it existed, are filled in from the times table.
+    '''
+    journal_path = _journal_path(times_path)
+    long_path = _long_path(times_path)
+    results = _journal_results(journal_path)
+    stored = set(results.LOC_ID)
+    if os.path.exists(long_path):
+        stored.update(pd.read_parquet(long_path, columns=['LOC_ID']).LOC_ID)
+    missing = [i for i in all_times.index if str(i) not in stored]
+    if missing:
+        results = pd.concat([results, _wide_results(all_times, missing)],
+                            ignore_index=True)
+    _update_long_times(long_path, results)
+    all_times.to_csv(times_path)
+    journal.remove(journal_path)
 
 
 def set_update_status_in_travel_times_csv(times_path,
@@ -39,14 +224,24 @@ def set_update_status_in_travel_times_csv(times_path,
     print(f'Setting Need_Update to {update_status} for {point_ids_str}')
     all_times.loc[point_ids, 'Need_Update'] = update_status
     print(f'Saving {times_path}')
-    all_times.to_csv(times_path)
+    _compact(all_times, times_path)
 
 
-def get_travel_times(point_file, allow_large=False, hospital_address=None):
+def get_travel_times(point_file, allow_large=False, hospital_address=None,
+                     workers=1, use_cache=True, snap=None, backend=None):
     '''
     Get travel times from each of the points in the given file to nearby
-        hospitals in the master hospital file
-    '''
+        hospitals in the master hospital file, keeping up to `workers`
+        requests in flight at once. Times already in the travel time cache
+        are used instead of making new requests. If snap is given, points in
+        the same grid cell of that size in meters share the travel times of
+        one representative point. The backend (see `routing`) defaults to
+        the Google Maps Distance Matrix API with traffic.
+    '''
+    if backend is None:
+        backend = routing.GoogleMapsBackend()
+    use_cache = use_cache and backend.cacheable
+
     points = population.load_points(point_file)
     if not allow_large and points.shape[0] > LARGE_LIMIT:
         point_count = points.shape[0]
@@ -58,11 +253,13 @@ def get_travel_times(point_file, allow_large=False, hospital_address=None):
 
     all_hospitals = hospitals.load_hospitals(hospital_address)
 
-    all_times_path = os.path.join(TIMES_DIR, os.path.basename(point_file))
+    name = os.path.splitext(os.path.basename(point_file))[0]
+    all_times_path = os.path.join(TIMES_DIR, name + '.csv')
+    journal_path = _journal_path(all_times_path)
     all_times = _get_travel_times_csv(all_times_path, points, all_hospitals)
-
-    # prim_data = all_hospitals[all_hospitals.CenterType == 'Primary']
-    comp_data = all_hospitals[all_hospitals.CenterType == 'Comprehensive']
+    # times with traffic are stored as "duration,duration_in_traffic"
+    all_times[all_hospitals.index] = all_times[all_hospitals.index].astype(
+        object)
 
     # Determine locations need to be calculated for
     # rows with all NaN values for all columns
@@ -70,82 +267,190 @@ def get_travel_times(point_file, allow_large=False, hospital_address=None):
     # (see set_update_status_in_travel_times_csv())
     selected_points = all_times.loc[all_times[all_hospitals.index].isna().all(
         axis=1) | all_times.Need_Update, ["Latitude", "Longitude"]]
-    pbar = tqdm(selected_points.iterrows(), total=selected_points.shape[0])
-    for loc_id, point in pbar:
-        pbar.set_description(f"Processing {loc_id}")
-        point = point.to_frame().T
-        # calling Gmap requests for prim and comprehensive seperately
-        # makes it really expensive and not needed
-        # limit to 20 hospitals overall, not by type
-        times = _get_travel_times_for_one_point(point, all_hospitals,
-                                                    'Centers')
-        # check if there's any comprehensive center
-        # if there isn't any, add in travel time for 5 closest Comprehensives
-        hospital_ids = times.drop(['Latitude', 'Longitude']).columns
-        if (all_hospitals.loc[hospital_ids,'CenterType'] == 'Comprehensive').all():
-            ctimes = _get_travel_times_for_one_point(point, comp_data,
-                                                    'Additional Comprehensives',
-                                                    max_n_hosps=5)
-            times = times.join(
-                ctimes.drop(columns=['Latitude', 'Longitude']))
-            
-        all_times.update(times, overwrite=True)
-        all_times.loc[loc_id,'Need_Update'] = False
-        all_times.to_csv(all_times_path)
-
-
-def _get_travel_times_for_one_point(point, some_hospitals, desc=None, with_traffic=True,
-                                    max_n_hosps=20):
+    if selected_points.empty:
+        print('No travel times to update')
+        if os.path.exists(journal_path):
+            _compact(all_times, all_times_path)
+        return
+
+    members = None
+    origins = selected_points
+    if snap:
+        # query once per grid cell, then copy times to every point in it
+        representative = geo.snap_points(selected_points, snap)
+        members = selected_points.index.groupby(representative)
+        origins = selected_points.loc[list(members)]
+
+    needed = _select_hospitals(origins, all_hospitals)
+    if snap:
+        saved = sum(len(needed[rep]) * (len(ids) - 1)
+                    for rep, ids in members.items())
+        print(f'Snapped {len(selected_points)} points to {len(origins)}' +
+              f' origins, saving {saved} travel time elements')
+    remaining = {loc_id: len(hosp_ids) for loc_id, hosp_ids in needed.items()}
+    # Results are appended to a journal as they arrive and only written to
+    #   the csv once at the end
+    all_times.loc[selected_points.index, 'Need_Update'] = True
+    journal.append(journal_path, [{'pending': list(selected_points.index)}])
+    departure_time = geo.get_depart_time() if backend.with_traffic else None
+    bucket = cache.departure_bucket(departure_time)
+
+    if use_cache:
+        # fill in anything we've already paid for before making requests
+        travel_cache = cache.get_travel_time_cache()
+        pairs = [(loc_id, hosp_id) for loc_id, hosp_ids in needed.items()
+                 for hosp_id in hosp_ids]
+        locs = _pair_locations(pairs, origins, all_hospitals)
+        found = travel_cache.get(locs, backend.mode, bucket)
+        _record_times(all_times, remaining, [pairs[i] for i in found],
+                      list(found.values()), journal_path, members)
+        cached = set(pairs[i] for i in found)
+        needed = {
+            loc_id: [h for h in hosp_ids if (loc_id, h) not in cached]
+            for loc_id, hosp_ids in needed.items() if remaining[loc_id]
+        }
+
+    requests = backend.plan(needed)
+    n_elements = sum(len(hosp_ids) for hosp_ids in needed.values())
+    print(f'Requesting {n_elements} travel times for {len(needed)} points' +
+          f' in {len(requests)} requests')
+
+    # Requests run concurrently, but only this thread touches all_times
+    pool = ThreadPoolExecutor(max_workers=workers)
+    error = None
+    try:
+        futures = {}
+        for loc_ids, hosp_ids in requests:
+            origin_locs = geo.extract_locations(origins.loc[loc_ids])
+            destinations = geo.extract_locations(all_hospitals.loc[hosp_ids])
+            future = pool.submit(backend.elements, origin_locs,
+                                 destinations, departure_time)
+            futures[future] = (loc_ids, hosp_ids)
+
+        for future in tqdm(as_completed(futures), total=len(futures),
+                           desc='Getting travel times'):
+            loc_ids, hosp_ids = futures[future]
+            try:
+                rows = future.result()
+            except Exception as e:
+                # stop making requests, but keep results that already came in
+                if error is None:
+                    error = e
+                    pool.shutdown(wait=False, cancel_futures=True)
+                continue
+            pairs = [(loc_id, hosp_id) for loc_id in loc_ids
+                     for hosp_id in hosp_ids]
+            elements = [el for row in rows for el in row]
+            if use_cache:
+                travel_cache.put(
+                    _pair_locations(pairs, origins, all_hospitals),
+                    elements, backend.mode, bucket, dest_ids=hosp_ids *
+                    len(loc_ids))
+            _record_times(all_times, remaining, pairs, elements, journal_path,
+                          members)
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    _compact(all_times, all_times_path)
+    if error is not None:
+        raise error
+
+    if use_cache:
+        print(travel_cache)
+
+
+def _pair_locations(pairs, points, all_hospitals):
     '''
-    Get travel times for a subset of hospitals (using only this subset to
-        determine which are "nearby")
+    Get (origin, destination) locations for a list of (LOC_ID, HOSP_ID) pairs
     '''
-    point_locs = geo.extract_locations(point)
-    hosp_locs = geo.extract_locations(some_hospitals)
-
-    distances = geo.distance_matrix(point_locs, hosp_locs, point.index,
-                                    some_hospitals.index)
-    times = point[['Latitude', 'Longitude']].copy()
-
-    client = maps.get_client()
+    if not pairs:
+        return []
+    loc_ids, hosp_ids = zip(*pairs)
+    origins = geo.extract_locations(points.loc[list(loc_ids)])
+    destinations = geo.extract_locations(all_hospitals.loc[list(hosp_ids)])
+    return list(zip(origins, destinations))
 
-    for i in times.index:
-        hosps = distances.loc[i]
-        include = hosps[hosps < hosps.Cutoff]
-        if len(include) > max_n_hosps:
-            # distance_matrix can only take 25 destinations, and we shouldn't
-            #   need to consider 25 hospitals anyway, so just drop farther away
-            #   ones if they're still there after the cutoff
-            include = include.sort_values().head(max_n_hosps)
-        grid_loc = geo.extract_locations(point.loc[[i]])
-        hosp_locs = geo.extract_locations(some_hospitals.loc[include.index])
-
-        if with_traffic:
-            matrix = client.distance_matrix(origins=grid_loc,
-                                            destinations=hosp_locs,
-                                            mode='driving',
-                                            departure_time=geo.get_depart_time(),
-                                            traffic_model='pessimistic')
-        else:
-            matrix = client.distance_matrix(origins=grid_loc,
-                                            destinations=hosp_locs,
-                                            mode='driving')
-
-        for this_row in matrix['rows']:
 
-            elements = this_row['elements']
-            for j, el in enumerate(elements):
-                col = include.index[j]
-                if el['status'] == 'OK':
-                    val = el['duration']['value'] / 60
-                    if 'duration_in_traffic' in list(el.keys()):
-                        tfc =  el['duration_in_traffic']['value'] / 60
-                        val = ','.join([str(val),str(tfc)])
-                else:
-                    val = np.NaN
-                times.loc[i, col] = val
-
-    return times
+def _record_times(all_times, remaining, pairs, elements, journal_path,
+                  members=None):
+    '''
+    Store (duration, traffic, status) elements for a list of (LOC_ID, HOSP_ID)
+        pairs in the times table and its journal, marking points as updated
+        once all of their remaining times have been recorded. If points were
+        snapped, members maps each representative LOC_ID to all the points
+        it stands for.
+    '''
+    if not pairs:
+        return
+    done = []
+    for loc_id, _ in pairs:
+        remaining[loc_id] -= 1
+        if remaining[loc_id] == 0:
+            done.extend([loc_id] if members is None else members[loc_id])
+
+    if members is not None:
+        pairs, elements = zip(*[((member, hosp_id), element)
+                                for (loc_id, hosp_id), element in zip(
+                                    pairs, elements)
+                                for member in members[loc_id]])
+    times = pd.Series([_format_time(*el) for el in elements],
+                      index=pd.MultiIndex.from_tuples(pairs),
+                      dtype=object).unstack()
+    all_times.update(times, overwrite=True)
+    all_times.loc[done, 'Need_Update'] = False
+
+    by_point = {}
+    for (loc_id, hosp_id), element in zip(pairs, elements):
+        by_point.setdefault(loc_id, {})[str(hosp_id)] = list(element)
+    records = [{
+        'LOC_ID': loc_id,
+        'times': point_times
+    } for loc_id, point_times in by_point.items()]
+    records += [{'LOC_ID': loc_id, 'done': True} for loc_id in done]
+    journal.append(journal_path, records)
+
+
+def _select_hospitals(points, all_hospitals, max_n_hosps=20, max_n_comps=5):
+    '''
+    Get the hospitals to compute travel times to for each point, as a dict
+        from point index to a list of hospital IDs. These are the nearby
+        hospitals (at most max_n_hosps of them, regardless of type), plus
+        the closest nearby comprehensive centers if none of those are
+        comprehensive.
+    '''
+    comp_data = all_hospitals[all_hospitals.CenterType == 'Comprehensive']
+    is_comp = all_hospitals.CenterType == 'Comprehensive'
+
+    locs = geo.extract_locations(points)
+    nearby = geo.HospitalIndex(all_hospitals).nearby(locs, points.index)
+    needed = {
+        loc_id: list(include.index[:max_n_hosps])
+        for loc_id, include in zip(points.index, nearby)
+    }
+
+    # check if there's any comprehensive center
+    # if there isn't any, add in travel time for 5 closest Comprehensives
+    no_comp = [
+        loc_id for loc_id, hosp_ids in needed.items()
+        if not is_comp[hosp_ids].any()
+    ]
+    if no_comp and not comp_data.empty:
+        comp_locs = geo.extract_locations(points.loc[no_comp])
+        comp_nearby = geo.HospitalIndex(comp_data).nearby(comp_locs, no_comp)
+        for loc_id, include in zip(no_comp, comp_nearby):
+            needed[loc_id] += list(include.index[:max_n_comps])
+
+    return needed
+
+
+def _format_time(duration, traffic, status=None):
+    '''
+    Format a travel time for the times CSV, as "duration,duration_in_traffic"
+        when traffic is available
+    '''
+    if pd.isnull(traffic):
+        return duration
+    return ','.join([str(duration), str(traffic)])
 
 
 def _get_travel_times(points, some_hospitals, desc=None):
@@ -185,7 +490,7 @@ def _get_travel_times(points, some_hospitals, desc=None):
                 if el['status'] == 'OK':
                     val = el['duration']['value'] / 60
                 else:
-                    val = np.NaN
+                    val = np.nan
                 times.loc[i, col] = val
 
     return times
@@ -194,7 +499,14 @@ def _get_travel_times(points, some_hospitals, desc=None):
 def main(args):
     point_file = args.point_file
     allow_large = args.allow_large
-    get_travel_times(point_file, allow_large)
+    workers = args.workers
+    use_cache = not args.no_cache
+    snap = args.snap
+    backend = None
+    if args.osm is not None:
+        backend = routing.LocalRoadBackend(args.osm)
+    get_travel_times(point_file, allow_large, workers=workers,
+                     use_cache=use_cache, snap=snap, backend=backend)
 
 
 if __name__ == '__main__':
@@ -203,5 +515,23 @@ if __name__ == '__main__':
     parser.add_argument('--allow_large',
                         action='store_true',
                         help='Allow more than 10 points')
+    parser.add_argument('--workers',
+                        '-w',
+                        type=int,
+                        default=1,
+                        help='Number of concurrent Google Maps requests')
+    parser.add_argument('--no_cache',
+                        action='store_true',
+                        help="Don't use or update the travel time cache")
+    parser.add_argument('--snap',
+                        type=float,
+                        default=None,
+                        help='Share travel times between points in the same' +
+                        ' grid cell of this size (meters)')
+    parser.add_argument('--osm',
+                        default=None,
+                        help='Compute times offline over the roads in this' +
+                        ' OpenStreetMap extract (.osm.pbf) instead of' +
+                        ' using Google Maps')
     args = parser.parse_args()
     main(args)
@@ -3,11 +3,14 @@ import urllib.request as ur
 import urllib.parse as up
 import json
 import data_io
+import cache
 from tools import MAPBOX_TOKEN
 
 addy_path = data_io.DTN_PATH / f'hospital_address_NE_for_stroke_locations.csv'
 
 df = pd.read_csv(addy_path, sep='|')
+# Mapbox searches already made aren't repeated
+geocodes = cache.get_geocode_cache()
 
 
 def get_best_result(results):
@@ -27,15 +30,24 @@ for idf, row in df.iterrows():
         row.PostalCode
     ]).dropna().values
     if len(for_join) == 0: continue
-    quote_address = up.quote_plus(' '.join(for_join))
-    print(quote_address)
-    mapbox_query = f'https://api.mapbox.com/geocoding/v5/mapbox.places/'\
-    +f'{quote_address}.json?access_token={MAPBOX_TOKEN}'
-    response = ur.urlopen(mapbox_query)
-    out = json.loads(response.read())
-    results = pd.DataFrame.from_dict(out['features'])
-    best_result = get_best_result(results)
-    if best_result is None: continue
+    searchterm = ' '.join(str(x) for x in for_join)
+    stored = geocodes.get(searchterm, 'mapbox')
+    if stored is None:
+        quote_address = up.quote_plus(searchterm)
+        print(quote_address)
+        mapbox_query = f'https://api.mapbox.com/geocoding/v5/mapbox.places/'\
+        +f'{quote_address}.json?access_token={MAPBOX_TOKEN}'
+        response = ur.urlopen(mapbox_query)
+        out = json.loads(response.read())
+        results = pd.DataFrame.from_dict(out['features'])
+        best_result = get_best_result(results)
+        chosen = (None if best_result is None else
+                  out['features'][best_result.name])
+        geocodes.put(searchterm, out['features'], chosen, 'mapbox')
+    else:
+        chosen = stored[1]
+    if chosen is None: continue
+    best_result = pd.Series(chosen)
     lon, lat = best_result.center
     context = pd.DataFrame.from_dict(best_result.context)[['id', 'text']]
     context.id = context.id.apply(lambda x: x.split('.')[0])
@@ -54,6 +66,7 @@ for idf, row in df.iterrows():
     contextl.append(result_parsed)
 
 all_results = pd.concat(contextl)
+print(geocodes)
 
 df[df.columns[:6]].join(all_results, how='outer').to_excel(
     'hospital_address_NE_for_stroke_locations_mapbox_search.xlsx', index=False)
@@ -9,6 +9,7 @@ import pandas as pd
 import plotly.graph_objects as go
 import plotly.offline as py
 import data_io
+import census
 from tools import MAPBOX_TOKEN
 
 
@@ -57,9 +58,7 @@ dff = pd.read_csv(
     skiprows=[1],
     dtype=str)
 dff.iloc[:, 3:] = dff.iloc[:, 3:].astype(int)
-male_count_columns = [f'HD01_VD{str(x).zfill(2)}' for x in range(18, 26)]
-female_count_columns = [f'HD01_VD{str(x).zfill(2)}' for x in range(42, 50)]
-dff['over_60'] = dff[male_count_columns + female_count_columns].sum(axis=1)
+dff['over_60'] = census.compute_weights(dff, 'acs', ['over_60']).over_60
 dff['total'] = dff['HD01_VD01']
 dff['GEOID'] = dff['GEO.id2']
 mdf = gdf.merge(dff[['GEOID', 'over_60', 'total']])